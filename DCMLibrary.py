@@ -6,6 +6,7 @@ import os
 import pydicom as pd
 import numpy as np
 from subprocess import call, DEVNULL
+from threading import Lock
 
 # Optional Modes
 DEBUG = False
@@ -20,11 +21,1916 @@ else:
 	cert = os.path.dirname(os.path.abspath(__file__)) + r'\CertFile.crt'
 	http += 's://'
 
+###########################################################################################################################
+### DICOM Directory Scanning ##############################################################################################
+###########################################################################################################################
+
+
+def _isDICOM(path):
+	"""
+	Cheaply check if a file is DICOM by its 128 byte preamble and DICM magic
+	"""
+	try:
+		with open(path, 'rb') as f:
+			return f.read(132)[128:] == b'DICM'
+	except:
+		return False
+
+
+def _scanPaths(inDir):
+	"""
+	Recursively yield the (path, size, mtime) of every file under a directory using os.scandir
+	"""
+	dirs = [inDir]
+	while dirs != []:
+		try:
+			entries = os.scandir(dirs.pop())
+		except OSError:
+			continue
+		with entries:
+			for entry in entries:
+				try:
+					if entry.is_dir(follow_symlinks=False):
+						dirs.append(entry.path)
+					elif entry.is_file():
+						stat = entry.stat()
+						yield entry.path, stat.st_size, stat.st_mtime
+				except OSError:
+					pass
+
+
+def _fileRecord(path, size=None, tags=None):
+	"""
+	Compact record of a DICOM file's path, size, and identifying UIDs, read from its header without the pixel data
+		tags adds more header keywords to the record, None if missing
+	"""
+	keywords = [
+	    'StudyInstanceUID', 'SeriesInstanceUID', 'SOPClassUID', 'SOPInstanceUID'
+	]
+	if tags != None:
+		keywords += tags
+	ds = pd.dcmread(path, stop_before_pixels=True, specific_tags=keywords)
+	if size == None:
+		size = os.path.getsize(path)
+	record = {
+	    'path': path,
+	    'size': size,
+	    'StudyInstanceUID': ds.get('StudyInstanceUID'),
+	    'SeriesInstanceUID': ds.get('SeriesInstanceUID'),
+	    'SOPInstanceUID': str(ds.SOPInstanceUID),
+	    'SOPClassUID': str(ds.SOPClassUID),
+	    'TransferSyntaxUID': str(ds.file_meta.TransferSyntaxUID)
+	}
+	for keyword in ['StudyInstanceUID', 'SeriesInstanceUID']:
+		if record[keyword] != None:
+			record[keyword] = str(record[keyword])
+	if tags != None:
+		for tag in tags:
+			record[tag] = ds.get(tag)
+	return record
+
+
+def _scanRecord(path, size=None, tags=None):
+	"""
+	File record of path if it is a DICOM file with SOP Class and Instance UIDs, otherwise None
+	"""
+	if not _isDICOM(path):
+		return None
+	try:
+		return _fileRecord(path, size, tags)
+	except:
+		return None
+
+
+def scanDCM(inDir, workers=None, processes=False, tags=None):
+	"""
+	Scan a DICOM file or directory of DICOM files into compact per file records without reading any pixel data
+		Works recursively through subdirectories, only parsing the headers of files with the DICM preamble magic
+		Set workers to parse headers on that many threads, or processes if processes is set
+		Records are dictionaries of path, size, Study/Series/SOP Instance UIDs, SOP Class UID, and Transfer Syntax UID
+		tags adds more header keywords to each record, e.g. ['Modality', 'InstanceNumber']
+		Returns output as a list of records, which C_STORE and STOW also take as input
+	"""
+	if os.path.isfile(inDir):
+		paths = [(inDir, None)]
+	elif os.path.isdir(inDir):
+		paths = [(path, size) for path, size, _mtime in _scanPaths(inDir)]
+	else:
+		print('Error: inDir is neither a file nor directory')
+		return []
+	return _scanRecords(paths, workers, processes, tags)
+
+
+def _scanRecords(paths, workers=None, processes=False, tags=None, skip=True):
+	"""
+	File records of (path, size) pairs, parsed on workers threads or processes if given
+		Set skip to leave out files which are not DICOM, otherwise their records are None
+	"""
+	if workers == None:
+		records = [_scanRecord(path, size, tags) for path, size in paths]
+	else:
+		from itertools import repeat
+		from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+		if processes:
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				records = list(
+				    executor.map(_scanRecord, [path for path, _size in paths],
+				                 [size for _path, size in paths],
+				                 repeat(tags),
+				                 chunksize=256))
+		else:
+			with ThreadPoolExecutor(max_workers=workers) as executor:
+				records = list(
+				    executor.map(_scanRecord, [path for path, _size in paths],
+				                 [size for _path, size in paths], repeat(tags)))
+	if skip:
+		return [record for record in records if record != None]
+	return records
+
+
+class DCMIndex(object):
+	"""
+	On-disk SQLite index of DICOM file headers so repeated scans of the same directories only parse changed files
+		path is the SQLite database file, created if it does not exist
+		update rescans a directory, records selects files by study, series, SOP Instance, or modality without touching
+		the filesystem, and its output can be given to C_STORE, STOW, renameDCM, resizeDCM, and loadVolumes as inDir
+	"""
+	tags = ['Modality', 'InstanceNumber', 'ImagePositionPatient']
+	columns = [
+	    'path', 'mtime', 'size', 'StudyInstanceUID', 'SeriesInstanceUID',
+	    'SOPInstanceUID', 'SOPClassUID', 'TransferSyntaxUID', 'Modality',
+	    'InstanceNumber', 'ImagePositionPatient'
+	]
+
+	def __init__(self, path):
+		import sqlite3
+
+		self.path = path
+		self.lock = Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute(
+		    'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+		    'StudyInstanceUID TEXT, SeriesInstanceUID TEXT, SOPInstanceUID TEXT, SOPClassUID TEXT, '
+		    'TransferSyntaxUID TEXT, Modality TEXT, InstanceNumber INTEGER, ImagePositionPatient TEXT)'
+		)
+		self.db.execute(
+		    'CREATE INDEX IF NOT EXISTS files_series ON files (StudyInstanceUID, SeriesInstanceUID)'
+		)
+		self.db.commit()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def update(self, inDir, workers=None, processes=False):
+		"""
+		Incrementally rescan a directory, only parsing files which are new or whose mtime or size changed
+			Files no longer under inDir are removed from the index, see scanDCM for workers and processes
+			Returns a dictionary of the number of files, parsed files, and removed files
+		"""
+		inDir = os.path.abspath(inDir)
+		with self.lock:
+			known = dict([
+			    (path, (mtime, size)) for path, mtime, size in self.db.execute(
+			        'SELECT path, mtime, size FROM files WHERE path >= ? AND path < ?',
+			        (inDir + os.sep, inDir + chr(ord(os.sep) + 1)))
+			])
+		files = list(_scanPaths(inDir))
+		changed = [(path, size, mtime) for path, size, mtime in files
+		           if known.get(path) != (mtime, size)]
+		records = _scanRecords([(path, size) for path, size, _mtime in changed],
+		                       workers, processes, self.tags, False)
+		rows = []
+		for (path, size, mtime), record in zip(changed, records):
+			# Files which are not DICOM are kept without UIDs so they are not checked again
+			if record == None:
+				record = {}
+			position = record.get('ImagePositionPatient')
+			if position != None:
+				position = '\\'.join([str(float(x)) for x in position])
+			number = record.get('InstanceNumber')
+			if number != None:
+				number = int(number)
+			rows.append(
+			    (path, mtime, size, record.get('StudyInstanceUID'),
+			     record.get('SeriesInstanceUID'), record.get('SOPInstanceUID'),
+			     record.get('SOPClassUID'), record.get('TransferSyntaxUID'),
+			     record.get('Modality'), number, position))
+		removed = set(known) - set([path for path, _size, _mtime in files])
+		with self.lock:
+			self.db.executemany(
+			    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+			    rows)
+			self.db.executemany('DELETE FROM files WHERE path = ?',
+			                    [(path, ) for path in removed])
+			self.db.commit()
+		print('Indexed ' + inDir + ': ' + str(len(files)) + ' files, ' +
+		      str(len(changed)) + ' parsed, ' + str(len(removed)) + ' removed')
+		return {
+		    'files': len(files),
+		    'parsed': len(changed),
+		    'removed': len(removed)
+		}
+
+	def records(self, study=None, series=None, SOP=None, modality=None):
+		"""
+		Records of the indexed DICOM files matching the given Study/Series/SOP Instance UIDs and modality
+			Records are scanDCM records with Modality, InstanceNumber, and ImagePositionPatient, ordered by series and InstanceNumber
+		"""
+		query = 'SELECT * FROM files WHERE SOPInstanceUID IS NOT NULL'
+		values = []
+		for column, value in [('StudyInstanceUID', study),
+		                      ('SeriesInstanceUID', series),
+		                      ('SOPInstanceUID', SOP), ('Modality', modality)]:
+			if value != None:
+				query += ' AND ' + column + ' = ?'
+				values.append(value)
+		query += ' ORDER BY StudyInstanceUID, SeriesInstanceUID, InstanceNumber'
+		with self.lock:
+			rows = self.db.execute(query, values).fetchall()
+		records = []
+		for row in rows:
+			record = dict(zip(self.columns, row))
+			del record['mtime']
+			if record['ImagePositionPatient'] != None:
+				record['ImagePositionPatient'] = [
+				    float(x) for x in record['ImagePositionPatient'].split('\\')
+				]
+			records.append(record)
+		return records
+
+	def series(self, study=None):
+		"""
+		List of (Study Instance UID, Series Instance UID, modality, number of instances) of the indexed series
+		"""
+		query = 'SELECT StudyInstanceUID, SeriesInstanceUID, Modality, COUNT(*) FROM files WHERE SOPInstanceUID IS NOT NULL'
+		values = []
+		if study != None:
+			query += ' AND StudyInstanceUID = ?'
+			values.append(study)
+		query += ' GROUP BY StudyInstanceUID, SeriesInstanceUID'
+		with self.lock:
+			return self.db.execute(query, values).fetchall()
+
+	def close(self):
+		"""
+		Close the database
+		"""
+		with self.lock:
+			self.db.close()
+
+
 ###########################################################################################################################
 ### DICOM Gateway #########################################################################################################
 ###########################################################################################################################
 
 
+def _encodeDS(ds):
+	"""
+	Encode a pydicom dataset to DICOM file bytes in memory
+	"""
+	from io import BytesIO
+
+	buf = BytesIO()
+	ds.save_as(buf)
+	return buf.getvalue()
+
+
+def _losslessSyntax(compress):
+	"""
+	Transfer Syntax UID to compress instances to before sending, None if compress is not set or has no encoder
+		compress is a Transfer Syntax UID, or True for the first available of JPEG-LS, JPEG 2000, and RLE Lossless
+	"""
+	if compress in [None, False]:
+		return None
+	if type(compress) == str:
+		syntaxes = [compress]
+	else:
+		syntaxes = [
+		    '1.2.840.10008.1.2.4.80', '1.2.840.10008.1.2.4.90',
+		    '1.2.840.10008.1.2.5'
+		]
+	try:
+		from pydicom.pixels import get_encoder
+	except ImportError:
+		try:
+			from pydicom.encoders import get_encoder
+		except ImportError:
+			print('Error: pydicom 2.2+ is needed to compress, sending instances as is')
+			return None
+	for syntax in syntaxes:
+		try:
+			if get_encoder(syntax).is_available:
+				return syntax
+		except:
+			pass
+	print('Error: No encoder available for ' + ', '.join(syntaxes) +
+	      ', sending instances as is')
+	return None
+
+
+def _compressDS(ds, syntax):
+	"""
+	Compress the pixel data of an uncompressed pydicom dataset in place to syntax
+		Returns None if the dataset has no pixel data, is already compressed, or fails to encode
+	"""
+	if 'PixelData' not in ds or ds.file_meta.TransferSyntaxUID.is_compressed:
+		return None
+	try:
+		try:
+			# Keep the SOP Instance UID, pydicom 3 makes a new one by default
+			ds.compress(syntax, generate_instance_uid=False)
+		except TypeError:
+			ds.compress(syntax)
+		return ds
+	except Exception as e:
+		if DEBUG:
+			print('Error: Failed to compress SOP Instance ' +
+			      str(ds.get('SOPInstanceUID')) + ', ' + str(e))
+		return None
+
+
+def _compressPart(part, syntax):
+	"""
+	Compress a (size, file path or encoded bytes, name) STOW part, returns the original part if it does not get smaller
+	"""
+	size, source, name = part
+	try:
+		if type(source) == bytes:
+			ds = pd.dcmread(pd.filebase.DicomBytesIO(source))
+		else:
+			ds = pd.dcmread(source)
+		if _compressDS(ds, syntax) == None:
+			return part
+		content = _encodeDS(ds)
+		if len(content) >= size:
+			return part
+		return (len(content), content, name)
+	except:
+		return part
+
+
+def _qidoURL(URL,
+             study=None,
+             series=None,
+             SOP=None,
+             patientId=None,
+             dataSource=None,
+             anonymize=None,
+             limit=None,
+             offset=None,
+             includefield=None,
+             fuzzy=False,
+             studyDate=None,
+             filters=None,
+             level=None):
+	"""
+	Build a QIDO-RS query URL, returns None if there are not enough values to query
+		Set level to 'series' or 'instance' to list every series of study, or instance of series
+	"""
+	from urllib.parse import urlencode
+
+	params = []
+	if level == 'series' and study != None and series == None and SOP == None:
+		URL += 'studies/' + study + '/series'
+	elif level == 'instance' and study != None and series != None and SOP == None:
+		URL += 'studies/' + study + '/series/' + series + '/instances'
+	elif patientId != None:
+		URL += 'studies'
+		params.append(('PatientID', patientId))
+	elif study != None and series == None and SOP == None:
+		URL += 'studies'
+		params.append(('StudyInstanceUID', study))
+	elif study != None and series != None and SOP == None:
+		URL += 'studies/' + study + '/series'
+		params.append(('SeriesInstanceUID', series))
+	elif study == None and series != None and SOP == None:
+		URL += 'series'
+		params.append(('SeriesInstanceUID', series))
+	elif study != None and series != None and SOP != None:
+		URL += 'studies/' + study + '/series/' + series + '/instances'
+		params.append(('SOPInstanceUID', SOP))
+	elif study != None and series == None and SOP != None:
+		URL += 'studies/' + study + '/instances'
+		params.append(('SOPInstanceUID', SOP))
+	elif study == None and series == None and SOP != None:
+		URL += 'instances'
+		params.append(('SOPInstanceUID', SOP))
+	elif studyDate != None or filters != None:
+		URL += 'studies'
+	else:
+		return None
+	if studyDate != None:
+		if type(studyDate) in [list, tuple]:
+			studyDate = '-'.join(studyDate)
+		params.append(('StudyDate', studyDate))
+	if filters != None:
+		for key in filters:
+			params.append((key, filters[key]))
+	if includefield != None:
+		if type(includefield) == str:
+			includefield = [includefield]
+		for field in includefield:
+			params.append(('includefield', field))
+	if fuzzy:
+		params.append(('fuzzymatching', 'true'))
+	if limit != None:
+		params.append(('limit', limit))
+	if offset != None:
+		params.append(('offset', offset))
+	if dataSource != None:
+		params.append(('datasource', dataSource))
+	if anonymize != None:
+		params.append(('anonymize', anonymize))
+	return URL + '?' + urlencode(params, safe='*,')
+
+
+def _wadoURL(URL,
+             study,
+             series=None,
+             SOP=None,
+             frames=None,
+             dataSource=None,
+             anonymize=None,
+             mode=None):
+	"""
+	Build a WADO-RS retrieve URL
+	"""
+	mode = str(mode)
+	URL += study
+	if series != None:
+		URL += '/series/' + series
+		if SOP != None:
+			URL += '/instances/' + SOP
+			if frames != None and mode.lower() not in ['xml', 'json']:
+				URL += '/frames/' + ','.join(
+				    [str(frame) for frame in _frameList(frames)])
+	if mode.lower() in ['xml', 'json']:
+		URL += '/metadata/'
+	params = []
+	if dataSource != None:
+		params.append('datasource=' + dataSource)
+	if anonymize != None:
+		params.append('anonymize=' + anonymize)
+	if params != []:
+		URL += '?' + '&'.join(params)
+	return URL
+
+
+def _stowParts(inDir):
+	"""
+	Collect (size, file path or encoded bytes, SOP Instance UID) STOW parts without reading files into memory
+		Returns None if inDir has no DICOM data
+	"""
+	parts = []
+	if type(inDir) == pd.dataset.FileDataset:
+		content = _encodeDS(inDir)
+		parts.append((len(content), content, inDir.SOPInstanceUID))
+	elif type(inDir) == list:
+		for ds in inDir:
+			if type(ds) == pd.dataset.FileDataset:
+				content = _encodeDS(ds)
+				parts.append((len(content), content, ds.SOPInstanceUID))
+			elif type(ds) == dict:
+				parts.append((ds['size'], ds['path'], ds['SOPInstanceUID']))
+		if parts == []:
+			print('Error: No DICOM files found in inDir')
+			return None
+	elif os.path.isdir(inDir):
+		for record in scanDCM(inDir):
+			parts.append(
+			    (record['size'], record['path'], record['SOPInstanceUID']))
+		if parts == []:
+			print('Error: No DICOM files found in inDir')
+			return None
+	elif os.path.isfile(inDir):
+		for record in scanDCM(inDir):
+			parts.append(
+			    (record['size'], record['path'], record['SOPInstanceUID']))
+		if parts == []:
+			print('Error: inDir is not a DICOM file. Skipping file...')
+	else:
+		print('Error: inDir is neither a file nor directory')
+		return None
+	return parts
+
+
+def _stowBatches(parts, maxInstances, maxBytes):
+	"""
+	Split STOW parts into batches capped by instance count and total bytes
+	"""
+	batches = []
+	batch = []
+	size = 0
+	for part in parts:
+		if batch != [] and (len(batch) >= maxInstances
+		                    or size + part[0] > maxBytes):
+			batches.append(batch)
+			batch = []
+			size = 0
+		batch.append(part)
+		size += part[0]
+	if batch != []:
+		batches.append(batch)
+	return batches
+
+
+def _frameList(frames):
+	"""
+	Normalize frame numbers given as an int, list, range, or string such as '1,3,5-8' to a list of ints
+	"""
+	if type(frames) == int:
+		return [frames]
+	if type(frames) == str:
+		out = []
+		for item in frames.split(','):
+			if '-' in item:
+				first, last = item.split('-')
+				out += list(range(int(first), int(last) + 1))
+			elif item.strip() != '':
+				out.append(int(item))
+		return out
+	return [int(frame) for frame in frames]
+
+
+def _transferSyntax(headers):
+	"""
+	Transfer syntax of a multipart part from its Content-Type, defaulting to Explicit VR Little Endian
+	"""
+	for param in headers.get('content-type', '').split(';'):
+		key, _, value = param.strip().partition('=')
+		if key.lower() == 'transfer-syntax':
+			return value.strip('"')
+	return '1.2.840.10008.1.2.1'
+
+
+def _decodeFrame(content, meta, transferSyntax):
+	"""
+	Decode raw frame bytes to a numpy array using the pixel attributes of the instance's DICOM JSON metadata
+		Native frames are read directly, compressed frames are decoded by pydicom
+	"""
+	def value(tag, default=None):
+		try:
+			return meta[tag]['Value'][0]
+		except:
+			return default
+
+	rows = value('00280010')
+	columns = value('00280011')
+	bits = value('00280100', 16)
+	signed = value('00280103', 0)
+	samples = value('00280002', 1)
+	planar = value('00280006', 0)
+	if transferSyntax in [
+	    '1.2.840.10008.1.2', '1.2.840.10008.1.2.1', '1.2.840.10008.1.2.2'
+	]:
+		if bits == 1:
+			raw = np.unpackbits(np.frombuffer(content, dtype=np.uint8),
+			                    bitorder='little')
+		else:
+			endian = '<'
+			if transferSyntax == '1.2.840.10008.1.2.2':
+				endian = '>'
+			dtype = np.dtype(endian + 'ui'[signed] + str(bits // 8))
+			raw = np.frombuffer(content, dtype=dtype).astype(
+			    dtype.newbyteorder('='))
+		raw = raw[:rows * columns * samples]
+		if samples == 1:
+			return raw.reshape(rows, columns)
+		elif planar == 1:
+			return raw.reshape(samples, rows, columns).transpose(1, 2, 0)
+		else:
+			return raw.reshape(rows, columns, samples)
+	else:
+		from pydicom.encaps import encapsulate
+
+		ds = pd.dataset.Dataset()
+		ds.file_meta = pd.dataset.FileMetaDataset()
+		ds.file_meta.TransferSyntaxUID = transferSyntax
+		ds.Rows = rows
+		ds.Columns = columns
+		ds.BitsAllocated = bits
+		ds.BitsStored = value('00280101', bits)
+		ds.HighBit = value('00280102', bits - 1)
+		ds.PixelRepresentation = signed
+		ds.SamplesPerPixel = samples
+		ds.PhotometricInterpretation = value('00280004', 'MONOCHROME2')
+		if samples > 1:
+			ds.PlanarConfiguration = planar
+		ds.NumberOfFrames = 1
+		ds.add_new(0x7FE00010, 'OB', encapsulate([content]))
+		ds['PixelData'].is_undefined_length = True
+		return ds.pixel_array
+
+
+def _iterMultipart(r, chunkSize=1048576):
+	"""
+	Incrementally parse a streamed multipart/related response
+		Yields a (headers, content) tuple for each part so that only one part is held in memory
+	"""
+	boundary = None
+	for param in r.headers.get('Content-Type', '').split(';'):
+		key, _, value = param.strip().partition('=')
+		if key.lower() == 'boundary':
+			boundary = value.strip('"').encode()
+	if boundary == None:
+		print('Error: No multipart boundary in response')
+		return
+	delimiter = b'\r\n--' + boundary
+	buf = bytearray(b'\r\n')
+	chunks = r.iter_content(chunkSize)
+
+	def fill():
+		chunk = next(chunks, None)
+		if chunk == None:
+			return False
+		buf.extend(chunk)
+		return True
+
+	# Skip the preamble up to the first boundary
+	while True:
+		i = buf.find(delimiter)
+		if i >= 0:
+			del buf[:i + len(delimiter)]
+			break
+		if not fill():
+			return
+	while True:
+		while len(buf) < 2:
+			if not fill():
+				return
+		if buf[:2] == b'--':
+			return
+		while True:
+			i = buf.find(b'\r\n\r\n')
+			if i >= 0:
+				headers = {}
+				for line in bytes(buf[:i]).decode(errors='ignore').split('\r\n'):
+					key, _, value = line.partition(':')
+					if key.strip() != '':
+						headers[key.strip().lower()] = value.strip()
+				del buf[:i + 4]
+				break
+			if not fill():
+				return
+		start = 0
+		while True:
+			i = buf.find(delimiter, start)
+			if i >= 0:
+				content = bytes(buf[:i])
+				del buf[:i + len(delimiter)]
+				break
+			start = max(0, len(buf) - len(delimiter))
+			if not fill():
+				return
+		yield headers, content
+
+
+class _MultipartStream(object):
+	"""
+	File-like multipart/related request body which streams each part from disk as it is read
+		parts is a list of (size, file path or encoded bytes, name) tuples
+	"""
+	def __init__(self, parts, chunkSize=1048576):
+		from uuid import uuid4
+
+		self.boundary = uuid4().hex
+		self.parts = parts
+		self.chunkSize = chunkSize
+		self.length = len(b'--' + self.boundary.encode() + b'--\r\n')
+		for part in parts:
+			self.length += len(self._header()) + part[0] + 2
+		# Current chunk and read offset into it, so reads never copy the unread remainder
+		self.chunk = memoryview(b'')
+		self.offset = 0
+		self.chunks = self._chunks()
+
+	def __len__(self):
+		return self.length
+
+	def _header(self):
+		return b'--' + self.boundary.encode(
+		) + b'\r\nContent-Type: application/dicom\r\n\r\n'
+
+	def _chunks(self):
+		for _size, source, _name in self.parts:
+			yield self._header()
+			if type(source) == bytes:
+				view = memoryview(source)
+				for i in range(0, len(view), self.chunkSize):
+					yield view[i:i + self.chunkSize]
+			else:
+				with open(source, 'rb') as f:
+					while True:
+						chunk = f.read(self.chunkSize)
+						if not chunk:
+							break
+						yield chunk
+			yield b'\r\n'
+		yield b'--' + self.boundary.encode() + b'--\r\n'
+
+	def read(self, size=-1):
+		out = []
+		n = 0
+		while size < 0 or n < size:
+			if self.offset >= len(self.chunk):
+				chunk = next(self.chunks, None)
+				if chunk == None:
+					break
+				self.chunk = memoryview(chunk)
+				self.offset = 0
+				continue
+			end = len(self.chunk)
+			if size >= 0:
+				end = min(end, self.offset + size - n)
+			out.append(self.chunk[self.offset:end])
+			n += end - self.offset
+			self.offset = end
+		return b''.join(out)
+
+
+def _stowStatus(status, content, parts):
+	"""
+	Parse a STOW-RS response into lists of stored SOP Instance UIDs and failed (SOP Instance UID, reason) pairs
+	"""
+	stored = []
+	failed = []
+	try:
+		import json
+
+		response = json.loads(content)
+		for item in response.get('00081199', {}).get('Value', []):
+			stored.append(item['00081155']['Value'][0])
+		for item in response.get('00081198', {}).get('Value', []):
+			reason = 'Failure reason ' + str(
+			    item.get('00081197', {}).get('Value', ['unknown'])[0])
+			failed.append((item['00081155']['Value'][0], reason))
+	except:
+		# No parsable response body, so rely on the status code for the whole batch
+		if status in [200, 202]:
+			stored = [part[2] for part in parts]
+		else:
+			failed = [(part[2], 'HTTP ' + str(status)) for part in parts]
+	return stored, failed
+
+
+class ResponseCache(object):
+	"""
+	TTL/LRU cache for QIDO and WADO metadata responses
+		Keeps up to maxEntries responses and maxBytes of content in memory, least recently used are evicted first
+		Set cacheDir to also keep responses on disk, up to diskBytes, so they persist between runs
+		Responses older than ttl seconds are revalidated with ETag/Last-Modified when the server supports it
+		hits, misses, revalidations, and evictions are counted, see stats
+	"""
+	def __init__(self,
+	             maxEntries=1024,
+	             maxBytes=268435456,
+	             ttl=300,
+	             cacheDir=None,
+	             diskBytes=1073741824):
+		from collections import OrderedDict
+
+		self.maxEntries = maxEntries
+		self.maxBytes = maxBytes
+		self.ttl = ttl
+		self.cacheDir = cacheDir
+		self.diskBytes = diskBytes
+		self.entries = OrderedDict()
+		self.size = 0
+		# Body sizes of the responses on disk, least recently used first
+		self.disk = OrderedDict()
+		self.diskSize = 0
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+		self.revalidations = 0
+		self.evictions = 0
+		if cacheDir != None:
+			if not os.path.isdir(cacheDir):
+				os.makedirs(cacheDir)
+			files = []
+			for f in os.scandir(cacheDir):
+				if f.name.endswith('.body'):
+					stat = f.stat()
+					files.append((stat.st_mtime, f.name[:-5], stat.st_size))
+			for _mtime, key, size in sorted(files):
+				self.disk[key] = size
+				self.diskSize += size
+
+	def key(self, URL, headers):
+		"""
+		Cache key from the normalized URL (including data source), Accept header, and a hash of the token
+		"""
+		from hashlib import sha256
+		from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+		parts = urlsplit(URL)
+		query = urlencode(sorted(parse_qsl(parts.query, True)))
+		URL = urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+		                  parts.path.rstrip('/'), query, ''))
+		auth = sha256(headers.get('Authorization', '').encode()).hexdigest()
+		return sha256(
+		    (URL + '\n' + headers.get('Accept', '') + '\n' + auth).encode()
+		).hexdigest()
+
+	def get(self, key):
+		"""
+		Look up a cached entry, returns the entry (or None) and whether it is still fresh
+		"""
+		from time import time
+
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry != None:
+				self.entries.move_to_end(key)
+		# Read from disk without the lock so other threads are not held up by the file I/O
+		if entry == None and self.cacheDir != None:
+			entry = self._load(key)
+		with self.lock:
+			if entry != None and key not in self.entries:
+				self._add(key, entry)
+				if key in self.disk:
+					self.disk.move_to_end(key)
+			fresh = entry != None and time() - entry['time'] < self.ttl
+			if fresh:
+				self.hits += 1
+			else:
+				self.misses += 1
+			return entry, fresh
+
+	def put(self, key, r):
+		"""
+		Cache a response
+		"""
+		from time import time
+
+		entry = {
+		    'status': r.status_code,
+		    'headers': dict(r.headers),
+		    'content': r.content,
+		    'time': time()
+		}
+		with self.lock:
+			if key in self.entries:
+				self.size -= len(self.entries.pop(key)['content'])
+			self._add(key, entry)
+		if self.cacheDir != None:
+			self._save(key, entry)
+
+	def revalidated(self, key):
+		"""
+		Mark a cached entry as fresh again after the server responded 304 Not Modified
+		"""
+		from time import time
+
+		with self.lock:
+			self.revalidations += 1
+			entry = self.entries.get(key)
+			if entry != None:
+				entry['time'] = time()
+		if entry != None and self.cacheDir != None:
+			self._save(key, entry)
+
+	def clear(self):
+		"""
+		Remove all cached responses from memory and disk
+		"""
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+			self.disk.clear()
+			self.diskSize = 0
+			if self.cacheDir != None:
+				for f in os.scandir(self.cacheDir):
+					if f.name.endswith('.meta') or f.name.endswith('.body'):
+						os.remove(f.path)
+
+	def stats(self):
+		"""
+		Hit/miss counters and current size of the cache
+		"""
+		with self.lock:
+			return {
+			    'hits': self.hits,
+			    'misses': self.misses,
+			    'revalidations': self.revalidations,
+			    'evictions': self.evictions,
+			    'entries': len(self.entries),
+			    'bytes': self.size
+			}
+
+	def _add(self, key, entry):
+		self.entries[key] = entry
+		self.size += len(entry['content'])
+		while len(self.entries) > 1 and (len(self.entries) > self.maxEntries
+		                                 or self.size > self.maxBytes):
+			_key, evicted = self.entries.popitem(last=False)
+			self.size -= len(evicted['content'])
+			self.evictions += 1
+
+	def _load(self, key):
+		import json
+
+		path = os.path.join(self.cacheDir, key)
+		try:
+			with open(path + '.meta', 'r') as f:
+				entry = json.load(f)
+			with open(path + '.body', 'rb') as f:
+				entry['content'] = f.read()
+			os.utime(path + '.body')
+		except:
+			return None
+		return entry
+
+	def _save(self, key, entry):
+		# Called without the lock, files are written to unique temporary files and renamed
+		# into place so concurrent writers of the same key do not interleave
+		import json
+		from tempfile import mkstemp
+
+		def write(target, content):
+			fd, tmp = mkstemp(dir=self.cacheDir)
+			try:
+				with os.fdopen(fd, 'wb') as f:
+					f.write(content)
+				os.replace(tmp, target)
+			except:
+				os.remove(tmp)
+				raise
+
+		path = os.path.join(self.cacheDir, key)
+		try:
+			write(path + '.body', entry['content'])
+			write(
+			    path + '.meta',
+			    json.dumps({
+			        'status': entry['status'],
+			        'headers': entry['headers'],
+			        'time': entry['time']
+			    }).encode())
+		except Exception as e:
+			print('Error: Unable to write response cache ' + str(e))
+			return
+		evicted = []
+		with self.lock:
+			self.diskSize -= self.disk.pop(key, 0)
+			self.disk[key] = len(entry['content'])
+			self.diskSize += len(entry['content'])
+			# Evict the least recently used responses from disk once over diskBytes
+			while self.diskSize > self.diskBytes and len(self.disk) > 1:
+				oldest, size = self.disk.popitem(last=False)
+				evicted.append(oldest)
+				self.diskSize -= size
+				self.evictions += 1
+		for oldest in evicted:
+			for ext in ['.body', '.meta']:
+				try:
+					os.remove(os.path.join(self.cacheDir, oldest + ext))
+				except OSError:
+					pass
+
+
+def _cachedResponse(entry):
+	"""
+	Rebuild a requests response from a cached entry
+	"""
+	from requests.structures import CaseInsensitiveDict
+
+	r = requests.models.Response()
+	r.status_code = entry['status']
+	r.headers = CaseInsensitiveDict(entry['headers'])
+	r._content = entry['content']
+	r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+	return r
+
+
+class TransferJournal(object):
+	"""
+	On-disk SQLite journal of per SOP Instance delivery status for C_STORE and STOW jobs
+		path is the SQLite database file, created if it does not exist
+		Pass as journal to C_STORE or STOW, and set resume to only send instances which are missing or failed
+		Each job is named by its destination unless given a job name
+	"""
+	def __init__(self, path):
+		import sqlite3
+
+		self.path = path
+		self.lock = Lock()
+		self.uncommitted = 0
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute(
+		    'CREATE TABLE IF NOT EXISTS transfers (job TEXT, SOPInstanceUID TEXT, path TEXT, bytes INTEGER, '
+		    'status TEXT, detail TEXT, created REAL, updated REAL, PRIMARY KEY (job, SOPInstanceUID))'
+		)
+		self.db.commit()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def register(self, job, instances):
+		"""
+		Add (SOP Instance UID, path, bytes) instances to a job as pending, keeping the status of known ones
+		"""
+		from time import time
+
+		with self.lock:
+			self.db.executemany(
+			    'INSERT OR IGNORE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+			    [(job, SOP, path, size, 'pending', None, time(), time())
+			     for SOP, path, size in instances])
+			self.db.commit()
+
+	def record(self, job, SOP, status, detail=None):
+		"""
+		Record the delivery status ('stored' or 'failed') of a SOP Instance
+		"""
+		from time import time
+
+		with self.lock:
+			cursor = self.db.execute(
+			    'UPDATE transfers SET status = ?, detail = ?, updated = ? WHERE job = ? AND SOPInstanceUID = ?',
+			    (status, detail, time(), job, SOP))
+			if cursor.rowcount == 0:
+				self.db.execute(
+				    'INSERT INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+				    (job, SOP, None, None, status, detail, time(), time()))
+			self.uncommitted += 1
+			if self.uncommitted >= 100:
+				self.db.commit()
+				self.uncommitted = 0
+
+	def delivered(self, job):
+		"""
+		Set of SOP Instance UIDs already stored for a job
+		"""
+		with self.lock:
+			return set([
+			    row[0] for row in self.db.execute(
+			        "SELECT SOPInstanceUID FROM transfers WHERE job = ? AND status = 'stored'",
+			        (job, ))
+			])
+
+	def summary(self, job):
+		"""
+		Summary of a job's instances, bytes, failures, and instances/sec
+		"""
+		with self.lock:
+			self.db.commit()
+			self.uncommitted = 0
+			counts = {'pending': 0, 'stored': 0, 'failed': 0}
+			for status, n in self.db.execute(
+			    'SELECT status, COUNT(*) FROM transfers WHERE job = ? GROUP BY status',
+			    (job, )):
+				counts[status] = n
+			size, first, last = self.db.execute(
+			    "SELECT SUM(bytes), MIN(created), MAX(updated) FROM transfers WHERE job = ? AND status = 'stored'",
+			    (job, )).fetchone()
+		seconds = 0
+		if first != None:
+			seconds = last - first
+		return {
+		    'instances': sum(counts.values()),
+		    'stored': counts['stored'],
+		    'failed': counts['failed'],
+		    'pending': counts['pending'],
+		    'bytes': size or 0,
+		    'seconds': seconds,
+		    'instancesPerSecond': counts['stored'] / max(seconds, 1e-6)
+		}
+
+	def close(self):
+		"""
+		Commit outstanding records and close the database
+		"""
+		with self.lock:
+			self.db.commit()
+			self.db.close()
+
+
+def _openJournal(journal):
+	"""
+	Open a TransferJournal from a path, returns the journal and whether the caller should close it
+	"""
+	if type(journal) == str:
+		return TransferJournal(journal), True
+	return journal, False
+
+
+def _printJournal(job, summary):
+	print('Journal ' + job + ': ' + str(summary['stored']) + '/' +
+	      str(summary['instances']) + ' instances stored (' +
+	      str(summary['bytes']) + ' bytes), ' + str(summary['failed']) +
+	      ' failed, ' + str(summary['pending']) + ' pending')
+
+
+class DICOMwebClient(object):
+	"""
+	Reusable DICOMweb client for QIDO, WADO, and STOW built on a pooled keep-alive session
+		URL is the DICOMweb base URL, QIDO queries go to URL and WADO/STOW requests to URL + 'studies/'
+		poolSize is the number of connections kept open per host
+		maxRetry and backoff set the retry policy for failed connections and 429/5xx responses
+		cache is an optional ResponseCache for QIDO and WADO metadata responses
+		Can be used as a context manager to close the pooled connections when done
+	"""
+	def __init__(self,
+	             URL=None,
+	             token=None,
+	             verify=True,
+	             poolSize=10,
+	             maxRetry=3,
+	             backoff=0.5,
+	             cache=None):
+		from requests.adapters import HTTPAdapter
+		from urllib3.util.retry import Retry
+
+		self.URL = URL
+		self.token = token
+		self.cache = cache
+		if verify == True:
+			verify = cert
+		self.verify = verify
+		retry = Retry(total=maxRetry,
+		              backoff_factor=backoff,
+		              status_forcelist=[429, 500, 502, 503, 504],
+		              raise_on_status=False)
+		adapter = HTTPAdapter(pool_connections=poolSize,
+		                      pool_maxsize=poolSize,
+		                      max_retries=retry)
+		self.session = requests.Session()
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		"""
+		Close all pooled connections
+		"""
+		self.session.close()
+
+	def _headers(self, token=None):
+		"""
+		Build request headers with the bearer token, if any
+		"""
+		headers = {}
+		if token == None:
+			token = self.token
+		if token != None:
+			headers['Authorization'] = 'Bearer ' + token
+		return headers
+
+	def _get(self, URL, headers, **kwargs):
+		return self.session.get(url=URL,
+		                        headers=headers,
+		                        verify=self.verify,
+		                        **kwargs)
+
+	def _cachedGet(self, URL, headers):
+		"""
+		GET a metadata response through the response cache, if there is one
+		"""
+		if self.cache == None:
+			return self._get(URL, headers)
+		key = self.cache.key(URL, headers)
+		entry, fresh = self.cache.get(key)
+		if entry != None and fresh:
+			return _cachedResponse(entry)
+		if entry != None:
+			conditional = dict(headers)
+			for k, v in entry['headers'].items():
+				if k.lower() == 'etag':
+					conditional['If-None-Match'] = v
+				elif k.lower() == 'last-modified':
+					conditional['If-Modified-Since'] = v
+			if len(conditional) > len(headers):
+				r = self._get(URL, conditional)
+				if r.status_code == 304:
+					self.cache.revalidated(key)
+					return _cachedResponse(entry)
+			else:
+				r = self._get(URL, headers)
+		else:
+			r = self._get(URL, headers)
+		if r.status_code == 200:
+			self.cache.put(key, r)
+		return r
+
+	def _post(self, URL, headers, **kwargs):
+		return self.session.post(url=URL,
+		                         headers=headers,
+		                         verify=self.verify,
+		                         **kwargs)
+
+	def QIDO(self,
+	         study=None,
+	         series=None,
+	         SOP=None,
+	         patientId=None,
+	         dataSource=None,
+	         anonymize=None,
+	         mode=None,
+	         limit=None,
+	         offset=None,
+	         includefield=None,
+	         fuzzy=False,
+	         studyDate=None,
+	         filters=None):
+		"""
+		Query for a DICOM study, series, or instance by it's UIDs
+			See the module level QIDO for options
+		"""
+		return self._QIDO(self.URL, study, series, SOP, patientId, dataSource,
+		                  anonymize, mode, None, limit, offset, includefield,
+		                  fuzzy, studyDate, filters)
+
+	def iterQIDO(self,
+	             study=None,
+	             series=None,
+	             SOP=None,
+	             patientId=None,
+	             dataSource=None,
+	             anonymize=None,
+	             pageSize=100,
+	             includefield=None,
+	             fuzzy=False,
+	             studyDate=None,
+	             filters=None,
+	             prefetch=True,
+	             maxPages=1000):
+		"""
+		Lazily page through QIDO results
+			See the module level iterQIDO for options
+		"""
+		return self._iterQIDO(self.URL, study, series, SOP, patientId,
+		                      dataSource, anonymize, None, pageSize,
+		                      includefield, fuzzy, studyDate, filters,
+		                      prefetch, maxPages)
+
+	def WADO(self,
+	         study,
+	         series=None,
+	         SOP=None,
+	         frames=None,
+	         dataSource=None,
+	         anonymize=None,
+	         mode=None,
+	         stream=False,
+	         outDir=None):
+		"""
+		Retrieve a DICOM study, series, or instance XML/JSON metadata or DICOM object binary
+			See the module level WADO for options
+		"""
+		return self._WADO(self.URL + 'studies/', study, series, SOP, frames,
+		                  dataSource, anonymize, mode, None, stream, outDir)
+
+	def STOW(self,
+	         inDir,
+	         study=None,
+	         dataSource=None,
+	         maxInstances=1024,
+	         maxBytes=536870912,
+	         workers=4,
+	         maxRetry=3,
+	         journal=None,
+	         resume=False,
+	         job=None,
+	         compress=None,
+	         compressWorkers=4):
+		"""
+		Store DICOM file(s) to server using RESTful API
+			See the module level STOW for options
+		"""
+		return self._STOW(self.URL + 'studies/', inDir, study, dataSource,
+		                  None, maxInstances, maxBytes, workers, maxRetry,
+		                  journal, resume, job, compress, compressWorkers)
+
+	def retrieveFrames(self,
+	                   study,
+	                   series,
+	                   SOP,
+	                   frames,
+	                   raw=False,
+	                   cacheDir=None,
+	                   dataSource=None):
+		"""
+		Retrieve frames of a DICOM instance as numpy arrays
+			See the module level retrieveFrames for options
+		"""
+		return self._retrieveFrames(self.URL + 'studies/', study, series, SOP,
+		                            frames, raw, cacheDir, dataSource)
+
+	def retrieveBulkdata(self, URI):
+		"""
+		Retrieve the bytes of a BulkDataURI
+		"""
+		return self._bulkdata(URI)
+
+	def retrieveStudy(self,
+	                  study,
+	                  outDir=None,
+	                  level='series',
+	                  workers=4,
+	                  maxRetry=3,
+	                  dataSource=None,
+	                  anonymize=None,
+	                  progress=True):
+		"""
+		Retrieve a whole DICOM study in parallel to a directory
+			See the module level retrieveStudy for options
+		"""
+		return self._retrieveStudy(self.URL, self.URL + 'studies/', study,
+		                           outDir, level, workers, maxRetry,
+		                           dataSource, anonymize, progress)
+
+	def _QIDO(self,
+	          URL,
+	          study=None,
+	          series=None,
+	          SOP=None,
+	          patientId=None,
+	          dataSource=None,
+	          anonymize=None,
+	          mode=None,
+	          token=None,
+	          limit=None,
+	          offset=None,
+	          includefield=None,
+	          fuzzy=False,
+	          studyDate=None,
+	          filters=None):
+		URL = _qidoURL(URL, study, series, SOP, patientId, dataSource,
+		               anonymize, limit, offset, includefield, fuzzy, studyDate,
+		               filters)
+		if URL == None:
+			print('Error: Not enough values to query')
+			return []
+		headers = self._headers(token)
+		mode = str(mode)
+		if mode.lower() == 'xml':
+			from requests_toolbelt.multipart import decoder
+			headers['Accept'] = 'multipart/related; type=application/dicom+xml'
+			r = self._cachedGet(URL, headers)
+			if r.status_code != 200 or DEBUG:
+				print(r.status_code)
+				print(r.text)
+			if r.status_code == 204:
+				return []
+			data = decoder.MultipartDecoder.from_response(r)
+			ds = []
+			for i in range(0, len(data.parts)):
+				ds.append(data.parts[i].content)
+			return ds
+		else:
+			headers['Accept'] = 'application/json'
+			r = self._cachedGet(URL, headers)
+			if r.status_code != 200 or DEBUG:
+				print(r.status_code)
+				print(r.text)
+			if r.status_code != 204:
+				return r.json()
+			else:
+				return []
+
+	def _iterQIDO(self,
+	              URL,
+	              study=None,
+	              series=None,
+	              SOP=None,
+	              patientId=None,
+	              dataSource=None,
+	              anonymize=None,
+	              token=None,
+	              pageSize=100,
+	              includefield=None,
+	              fuzzy=False,
+	              studyDate=None,
+	              filters=None,
+	              prefetch=True,
+	              maxPages=1000,
+	              level=None):
+		from concurrent.futures import ThreadPoolExecutor
+
+		headers = self._headers(token)
+		headers['Accept'] = 'application/json'
+
+		def page(offset):
+			pageURL = _qidoURL(URL, study, series, SOP, patientId, dataSource,
+			                   anonymize, pageSize, offset, includefield,
+			                   fuzzy, studyDate, filters, level)
+			r = self._cachedGet(pageURL, headers)
+			if r.status_code not in [200, 204] or DEBUG:
+				print(r.status_code)
+				print(r.text)
+			if r.status_code != 200:
+				return [], False
+			# Servers may cap the page size and signal remaining results with a Warning header
+			return r.json(), 'warning' in [k.lower() for k in r.headers]
+
+		if _qidoURL(URL, study, series, SOP, patientId, dataSource, anonymize,
+		            None, None, None, False, studyDate, filters, level) == None:
+			print('Error: Not enough values to query')
+			return
+		executor = ThreadPoolExecutor(max_workers=1)
+		try:
+			offset = 0
+			pages = 0
+			previous = None
+			future = executor.submit(page, offset)
+			while future != None:
+				results, more = future.result()
+				pages += 1
+				future = None
+				# Servers that ignore offset return the same page forever
+				if results != [] and results == previous:
+					break
+				previous = results
+				offset += len(results)
+				# Servers that ignore limit return everything in one page
+				nextPage = results != [] and len(results) <= pageSize and (
+				    len(results) == pageSize or more)
+				if nextPage and pages >= maxPages:
+					print('Warning: Stopped QIDO paging after ' + str(pages) +
+					      ' pages')
+					nextPage = False
+				if nextPage:
+					if prefetch:
+						future = executor.submit(page, offset)
+					else:
+						for result in results:
+							yield result
+						results = []
+						future = executor.submit(page, offset)
+				for result in results:
+					yield result
+		finally:
+			executor.shutdown(wait=False)
+
+	def _WADO(self,
+	          URL,
+	          study,
+	          series=None,
+	          SOP=None,
+	          frames=None,
+	          dataSource=None,
+	          anonymize=None,
+	          mode=None,
+	          token=None,
+	          stream=False,
+	          outDir=None):
+		mode = str(mode)
+		URL = _wadoURL(URL, study, series, SOP, frames, dataSource, anonymize,
+		               mode)
+		headers = self._headers(token)
+		if mode.lower() == 'json':
+			headers['Accept'] = 'application/dicom+json'
+			r = self._cachedGet(URL, headers)
+			if r.status_code != 200 or DEBUG:
+				print(r.status_code)
+				print(r.text)
+			return r.json()
+		elif mode.lower() == 'xml':
+			headers['Accept'] = 'application/dicom+xml'
+			r = self._cachedGet(URL, headers)
+			if r.status_code not in [200, 206] or DEBUG:
+				print(r.status_code)
+				print(r.text)
+			return r.content
+		elif frames != None and SOP != None:
+			headers[
+			    'Accept'] = 'multipart/related; type="application/octet-stream"; transfer-syntax=*'
+			r = self._get(URL, headers, stream=True)
+			if r.status_code != 200 or DEBUG:
+				print(r.status_code)
+				if r.status_code != 200:
+					print(r.text)
+			try:
+				if r.status_code != 200:
+					return []
+				return [content for _headers, content in _iterMultipart(r)]
+			finally:
+				r.close()
+		else:
+			from requests_toolbelt.multipart import decoder
+			headers['Accept'] = 'multipart/related; type=application/dicom'
+			r = self._get(URL, headers, stream=stream)
+			if r.status_code != 200 or DEBUG:
+				print(r.status_code)
+				if r.status_code != 200:
+					print(r.text)
+			if stream:
+				return self._iterWADO(r, outDir)
+			data = decoder.MultipartDecoder.from_response(r)
+			ds = []
+			for i in range(len(data.parts)):
+				ds.append(
+				    pd.dcmread(pd.filebase.DicomBytesIO(data.parts[i].content)))
+			return ds
+
+	def _retrieveFrames(self,
+	                    URL,
+	                    study,
+	                    series,
+	                    SOP,
+	                    frames,
+	                    raw=False,
+	                    cacheDir=None,
+	                    dataSource=None,
+	                    token=None):
+		frames = _frameList(frames)
+		ext = '.npy'
+		if raw:
+			ext = '.raw'
+		out = {}
+		missing = []
+		for frame in frames:
+			path = None
+			if cacheDir != None:
+				path = os.path.join(cacheDir, SOP, str(frame) + ext)
+			if path != None and os.path.isfile(path):
+				if raw:
+					with open(path, 'rb') as f:
+						out[frame] = f.read()
+				else:
+					out[frame] = np.load(path)
+			elif frame not in missing:
+				missing.append(frame)
+		if missing != []:
+			meta = None
+			if not raw:
+				meta = self._WADO(URL, study, series, SOP, None, dataSource,
+				                  None, 'json', token)
+				if type(meta) == list and meta != []:
+					meta = meta[0]
+			frameURL = URL + study + '/series/' + series + '/instances/' + SOP + '/frames/' + ','.join(
+			    [str(frame) for frame in missing])
+			if dataSource != None:
+				frameURL += '?datasource=' + dataSource
+			headers = self._headers(token)
+			headers[
+			    'Accept'] = 'multipart/related; type="application/octet-stream"; transfer-syntax=*'
+			r = self._get(frameURL, headers, stream=True)
+			if r.status_code != 200 or DEBUG:
+				print(r.status_code)
+				if r.status_code != 200:
+					print(r.text)
+			try:
+				if r.status_code == 200:
+					for frame, (partHeaders, content) in zip(
+					    missing, _iterMultipart(r)):
+						if raw:
+							out[frame] = content
+						else:
+							out[frame] = _decodeFrame(content, meta,
+							                          _transferSyntax(partHeaders))
+						if cacheDir != None:
+							if not os.path.isdir(os.path.join(cacheDir, SOP)):
+								os.makedirs(os.path.join(cacheDir, SOP))
+							path = os.path.join(cacheDir, SOP, str(frame) + ext)
+							if raw:
+								with open(path, 'wb') as f:
+									f.write(content)
+							else:
+								np.save(path, out[frame])
+			finally:
+				r.close()
+		found = [frame for frame in frames if frame in out]
+		if len(found) < len(frames):
+			print('Error: Unable to retrieve frames ' + ', '.join(
+			    [str(frame) for frame in frames if frame not in out]))
+		if raw:
+			return [out[frame] for frame in found]
+		if found == []:
+			return np.array([])
+		return np.stack([out[frame] for frame in found])
+
+	def _bulkdata(self, URI, token=None):
+		headers = self._headers(token)
+		headers[
+		    'Accept'] = 'multipart/related; type="application/octet-stream"; transfer-syntax=*'
+		r = self._get(URI, headers, stream=True)
+		if r.status_code != 200 or DEBUG:
+			print(r.status_code)
+			if r.status_code != 200:
+				print(r.text)
+		try:
+			if r.status_code != 200:
+				return b''
+			if not r.headers.get('Content-Type',
+			                     '').lower().startswith('multipart'):
+				return r.content
+			return b''.join(
+			    [content for _headers, content in _iterMultipart(r)])
+		finally:
+			r.close()
+
+	def _iterWADO(self, r, outDir=None):
+		"""
+		Parse a streamed WADO multipart response one instance at a time
+			Yields pydicom datasets, or the saved file paths if given outDir
+		"""
+		from re import fullmatch
+
+		try:
+			if r.status_code != 200:
+				return
+			n = 0
+			for _headers, content in _iterMultipart(r):
+				if outDir == None:
+					yield pd.dcmread(pd.filebase.DicomBytesIO(content))
+				else:
+					try:
+						name = str(
+						    pd.dcmread(pd.filebase.DicomBytesIO(content),
+						               stop_before_pixels=True).SOPInstanceUID)
+					except:
+						name = ''
+					# The UID comes from the server, so only use it as a file name if it is a valid UID
+					if fullmatch('[0-9.]+', name) == None:
+						name = 'IMG' + str(n)
+					path = os.path.join(outDir, name + '.dcm')
+					with open(path, 'wb') as f:
+						f.write(content)
+					yield path
+				n += 1
+		finally:
+			r.close()
+
+	def _STOW(self,
+	          URL,
+	          inDir,
+	          study=None,
+	          dataSource=None,
+	          token=None,
+	          maxInstances=1024,
+	          maxBytes=536870912,
+	          workers=4,
+	          maxRetry=3,
+	          journal=None,
+	          resume=False,
+	          job=None,
+	          compress=None,
+	          compressWorkers=4):
+		from concurrent.futures import ThreadPoolExecutor
+
+		if study != None:
+			URL += study
+		if dataSource != None:
+			URL += '?datasource=' + dataSource
+		headers = self._headers(token)
+		headers['Accept'] = 'application/dicom+json'
+
+		parts = _stowParts(inDir)
+		if parts == None:
+			return {}
+		syntax = _losslessSyntax(compress)
+		journal, closeJournal = _openJournal(journal)
+		if journal != None:
+			if job == None:
+				job = 'STOW ' + URL
+			journal.register(job, [(part[2], None if type(part[1]) == bytes
+			                        else part[1], part[0]) for part in parts])
+			if resume:
+				delivered = journal.delivered(job)
+				print('Resuming ' + job + ', skipping ' + str(
+				    len([part for part in parts if part[2] in delivered])) +
+				      ' instances already stored')
+				parts = [part for part in parts if part[2] not in delivered]
+		batches = _stowBatches(parts, maxInstances, maxBytes)
+		compressor = None
+		if syntax != None:
+			compressor = ThreadPoolExecutor(max_workers=compressWorkers)
+
+		def send(i, batch):
+			for j in range(maxRetry):
+				try:
+					body = _MultipartStream(batch)
+					batchHeaders = dict(headers)
+					batchHeaders[
+					    'Content-Type'] = 'multipart/related; type="application/dicom"; boundary=' + body.boundary
+					r = self._post(URL, batchHeaders, data=body)
+					print(
+					    str(r.status_code) + ' (batch ' + str(i + 1) + '/' +
+					    str(len(batches)) + ', ' + str(len(batch)) +
+					    ' instances)')
+					if r.status_code not in [200, 202] or DEBUG:
+						print(r.text)
+					if r.status_code < 500 or j == maxRetry - 1:
+						return r.status_code, r.content, _stowStatus(
+						    r.status_code, r.content, batch)
+				except Exception as e:
+					print('Error: ' + str(e))
+			reason = 'Failed to STOW after ' + str(maxRetry) + ' attempts'
+			return None, b'', ([], [(part[2], reason) for part in batch])
+
+		def post(i):
+			# Returns the status and content of each request made for the batch
+			batch = batches[i]
+			if compressor == None:
+				status, content, result = send(i, batch)
+				return [status], [content], result
+			compressed = list(
+			    compressor.map(lambda part: _compressPart(part, syntax), batch))
+			status, content, (stored, failed) = send(i, compressed)
+			if status == None:
+				return [status], [content], (stored, failed)
+			# Send the instances the peer would not accept compressed as they were
+			failedUIDs = [SOP for SOP, _reason in failed]
+			retry = [
+			    batch[k] for k in range(len(batch))
+			    if compressed[k] is not batch[k] and batch[k][2] in failedUIDs
+			]
+			if retry == []:
+				return [status], [content], (stored, failed)
+			print('Retrying ' + str(len(retry)) +
+			      ' instances of batch ' + str(i + 1) + ' uncompressed')
+			retryStatus, retryContent, (retryStored,
+			                            retryFailed) = send(i, retry)
+			retryUIDs = [part[2] for part in retry]
+			failed = [(SOP, reason) for SOP, reason in failed
+			          if SOP not in retryUIDs] + retryFailed
+			return ([status, retryStatus], [content, retryContent],
+			        (stored + retryStored, failed))
+
+		def postAndRecord(i):
+			result = post(i)
+			if journal != None:
+				for SOP in result[2][0]:
+					journal.record(job, SOP, 'stored')
+				for SOP, reason in result[2][1]:
+					journal.record(job, SOP, 'failed', reason)
+			return result
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(postAndRecord, range(len(batches))))
+		if compressor != None:
+			compressor.shutdown()
+		output = {'status': [], 'content': [], 'stored': [], 'failed': []}
+		for status, content, (stored, failed) in results:
+			output['status'] += status
+			output['content'] += content
+			output['stored'] += stored
+			output['failed'] += failed
+		if len(batches) > 1:
+			print('STOWed ' + str(len(output['stored'])) + ' instances in ' +
+			      str(len(batches)) + ' batches, ' +
+			      str(len(output['failed'])) + ' failed')
+		if journal != None:
+			output['journal'] = journal.summary(job)
+			_printJournal(job, output['journal'])
+			if closeJournal:
+				journal.close()
+		return output
+
+	def _retrieveStudy(self,
+	                   qidoURL,
+	                   wadoURL,
+	                   study,
+	                   outDir=None,
+	                   level='series',
+	                   workers=4,
+	                   maxRetry=3,
+	                   dataSource=None,
+	                   anonymize=None,
+	                   progress=True,
+	                   token=None):
+		from concurrent.futures import ThreadPoolExecutor, as_completed
+
+		if outDir == None:
+			from tempfile import mkdtemp
+			outDir = mkdtemp()
+		elif not os.path.isdir(outDir):
+			os.makedirs(outDir)
+
+		def uids(series, tag):
+			# Page through every result, servers may cap a single response
+			values = []
+			for item in self._iterQIDO(qidoURL,
+			                           study,
+			                           series,
+			                           dataSource=dataSource,
+			                           token=token,
+			                           level='series'
+			                           if series == None else 'instance'):
+				if item.get(tag, {}).get('Value', []) != []:
+					values.append(item[tag]['Value'][0])
+			return values
+
+		# Fan out QIDO to list the series, and instances if retrieving at instance level
+		items = []
+		for series in uids(None, '0020000E'):
+			if level.lower() == 'instance':
+				for SOP in uids(series, '00080018'):
+					items.append((series, SOP))
+			else:
+				items.append((series, None))
+		if items == []:
+			print('Error: No series found for study ' + study)
+			return {'outDir': outDir, 'files': [], 'failed': []}
+
+		def retrieve(item):
+			for i in range(maxRetry):
+				try:
+					files = list(
+					    self._WADO(wadoURL, study, item[0], item[1], None,
+					               dataSource, anonymize, None, token, True,
+					               outDir))
+					if files != []:
+						return files
+					print('Error: No instances retrieved for ' + '/'.join(
+					    [uid for uid in item if uid != None]))
+				except Exception as e:
+					print('Error: ' + str(e))
+			return None
+
+		files = []
+		failed = []
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = {executor.submit(retrieve, item): item for item in items}
+			for n, future in enumerate(as_completed(futures)):
+				item = futures[future]
+				result = future.result()
+				if result == None:
+					failed.append(item)
+				else:
+					files += result
+				if callable(progress):
+					progress(n + 1, len(items), item)
+				elif progress:
+					print('Retrieved ' + str(n + 1) + '/' + str(len(items)) +
+					      ' ' + level.lower() + ' (' + str(len(files)) +
+					      ' instances)')
+		if failed != []:
+			print('Error: Failed to retrieve ' + str(len(failed)) + ' ' +
+			      level.lower() + ' after ' + str(maxRetry) + ' attempts')
+		return {'outDir': outDir, 'files': files, 'failed': failed}
+
+
+# Shared clients used by the module level QIDO, WADO, and STOW, one per verify setting
+_clients = {}
+_clientsLock = Lock()
+_cache = None
+
+
+def _getClient(verify=True):
+	"""
+	Get the shared pooled DICOMweb client for a verify setting
+	"""
+	with _clientsLock:
+		if verify not in _clients:
+			_clients[verify] = DICOMwebClient(verify=verify, cache=_cache)
+		return _clients[verify]
+
+
+def enableCache(maxEntries=1024,
+                maxBytes=268435456,
+                ttl=300,
+                cacheDir=None,
+                diskBytes=1073741824):
+	"""
+	Enable caching of QIDO and WADO metadata responses for the module level functions
+		See ResponseCache for options
+		Returns the ResponseCache
+	"""
+	global _cache
+	with _clientsLock:
+		_cache = ResponseCache(maxEntries, maxBytes, ttl, cacheDir, diskBytes)
+		for verify in _clients:
+			_clients[verify].cache = _cache
+	return _cache
+
+
+def disableCache():
+	"""
+	Disable caching of QIDO and WADO metadata responses for the module level functions
+	"""
+	global _cache
+	with _clientsLock:
+		_cache = None
+		for verify in _clients:
+			_clients[verify].cache = None
+
+
+def cacheStats():
+	"""
+	Hit/miss counters of the module level response cache, empty if caching is disabled
+	"""
+	if _cache == None:
+		return {}
+	return _cache.stats()
+
+
 def QIDO(URL,
          study=None,
          series=None,
@@ -34,64 +1940,58 @@ def QIDO(URL,
          anonymize=None,
          mode=None,
          token=None,
-         verify=True):
+         verify=True,
+         limit=None,
+         offset=None,
+         includefield=None,
+         fuzzy=False,
+         studyDate=None,
+         filters=None):
 	"""
 	Query for a DICOM study, series, or instance by it's UIDs
 		Options for anonymize are None and 'yes'
 		Option for mode are None and 'xml'
 		Assumes JSON if mode is None
+		limit and offset select one page of a large result set, see iterQIDO to page through all of it
+		includefield is an attribute keyword/tag or list of them to return, or 'all'
+		Set fuzzy to enable fuzzy matching of person names
+		studyDate is a date 'YYYYMMDD' or range 'YYYYMMDD-YYYYMMDD' or ('YYYYMMDD', 'YYYYMMDD') (either end may be blank)
+		filters is a dictionary of additional matching attributes, such as {'ModalitiesInStudy': 'CT'}
+		If no UIDs or patientId are given, studyDate and filters query at the study level
+		Reuses pooled connections between calls, use DICOMwebClient for control over pooling and retries
 	"""
-	if patientId != None:
-		URL += 'studies?PatientID=' + patientId
-	elif study != None and series == None and SOP == None:
-		URL += 'studies?StudyInstanceUID=' + study
-	elif study != None and series != None and SOP == None:
-		URL += 'studies/' + study + '/series?SeriesInstanceUID=' + series
-	elif study == None and series != None and SOP == None:
-		URL += 'series?SeriesInstanceUID=' + series
-	elif study != None and series != None and SOP != None:
-		URL += 'studies/' + study + '/series/' + series + '/instances?SOPInstanceUID=' + SOP
-	elif study != None and series == None and SOP != None:
-		URL += 'studies/' + study + '/instances?SOPInstanceUID=' + SOP
-	elif study == None and series == None and SOP != None:
-		URL += 'instances?SOPInstanceUID=' + SOP
-	else:
-		print('Error: Not enough values to query')
-		return []
-	if dataSource != None:
-		URL += '?datasource=' + dataSource
-	if anonymize != None:
-		URL += '?anonymize=' + anonymize
-	headers = {}
-	if token != None:
-		headers['Authorization'] = 'Bearer ' + token
-	mode = str(mode)
-	if verify == True:
-		verify = cert
-	if mode.lower() == 'xml':
-		from requests_toolbelt.multipart import decoder
-		headers['Accept'] = 'multipart/related; type=application/dicom+xml'
-		r = requests.get(url=URL, headers=headers, verify=verify)
-		if r.status_code != 200 or DEBUG:
-			print(r.status_code)
-			print(r.text)
-		if r.status_code == 204:
-			return []
-		data = decoder.MultipartDecoder.from_response(r)
-		ds = []
-		for i in range(0, len(data.parts)):
-			ds.append(data.parts[i].content)
-		return ds
-	else:
-		headers['Accept'] = 'application/json'
-		r = requests.get(url=URL, headers=headers, verify=verify)
-		if r.status_code != 200 or DEBUG:
-			print(r.status_code)
-			print(r.text)
-		if r.status_code != 204:
-			return r.json()
-		else:
-			return []
+	return _getClient(verify)._QIDO(URL, study, series, SOP, patientId,
+	                                dataSource, anonymize, mode, token, limit,
+	                                offset, includefield, fuzzy, studyDate,
+	                                filters)
+
+
+def iterQIDO(URL,
+             study=None,
+             series=None,
+             SOP=None,
+             patientId=None,
+             dataSource=None,
+             anonymize=None,
+             token=None,
+             verify=True,
+             pageSize=100,
+             includefield=None,
+             fuzzy=False,
+             studyDate=None,
+             filters=None,
+             prefetch=True,
+             maxPages=1000):
+	"""
+	Generator of QIDO JSON results which fetches pages of pageSize results lazily using limit and offset
+		Takes the same query options as QIDO
+		Set prefetch to fetch the next page in the background while the current page is being handled
+		Paging stops after maxPages pages, or when the server ignores limit or offset
+	"""
+	return _getClient(verify)._iterQIDO(URL, study, series, SOP, patientId,
+	                                    dataSource, anonymize, token, pageSize,
+	                                    includefield, fuzzy, studyDate,
+	                                    filters, prefetch, maxPages)
 
 
 def WADO(URL,
@@ -103,64 +2003,82 @@ def WADO(URL,
          anonymize=None,
          mode=None,
          token=None,
-         verify=True):
+         verify=True,
+         stream=False,
+         outDir=None):
 	"""
 	Retrieve a DICOM study, series, or instance XML/JSON metadata or DICOM object binary
 		Options for anonymize are None and 'yes'
 		Options for mode are None, 'xml', and 'json'
 		Assumes DICOM object binary if mode is None
+		If given frames with SOP, returns a list of the raw frame bytes, see retrieveFrames to decode them
+		Set stream to parse the binary response as it arrives and return a generator of datasets
+		Set outDir with stream to write each instance straight to a file and yield its path instead
+		Reuses pooled connections between calls, use DICOMwebClient for control over pooling and retries
 		
 		NOTE: You must save the DICOM data to a file in order to read it's pixel array data
 		This is because of the way PIL/GDCM reads image pixel data, which is called upon by pydicom
 		Use exportDS to easily save WADO-RS DICOM object binary results
 	"""
-	URL += study
-	if series != None:
-		URL += '/series/' + series
-		if SOP != None:
-			URL += '/instances/' + SOP
-			if frames != None:
-				URL += '/frames/' + frames
-	mode = str(mode)
-	if mode.lower() in ['xml', 'json']:
-		URL += '/metadata/'
-	if dataSource != None:
-		URL += '?datasource=' + dataSource
-	if anonymize != None:
-		URL += '?anonymize=' + anonymize
-	headers = {}
-	if token != None:
-		headers['Authorization'] = 'Bearer ' + token
-	if verify == True:
-		verify = cert
-	if mode.lower() == 'json':
-		headers['Accept'] = 'application/dicom+json'
-		r = requests.get(url=URL, headers=headers, verify=verify)
-		if r.status_code != 200 or DEBUG:
-			print(r.status_code)
-			print(r.text)
-		return r.json()
-	elif mode.lower() == 'xml':
-		headers['Accept'] = 'application/dicom+xml'
-		r = requests.get(url=URL, headers=headers, verify=verify)
-		if r.status_code not in [200, 206] or DEBUG:
-			print(r.status_code)
-			print(r.text)
-		return r.content
-	else:
-		from requests_toolbelt.multipart import decoder
-		headers['Accept'] = 'multipart/related; type=application/dicom'
-		r = requests.get(url=URL, headers=headers, verify=verify)
-		if r.status_code != 200 or DEBUG:
-			print(r.status_code)
-			if r.status_code != 200:
-				print(r.text)
-		data = decoder.MultipartDecoder.from_response(r)
-		ds = []
-		for i in range(len(data.parts)):
-			ds.append(
-			    pd.dcmread(pd.filebase.DicomBytesIO(data.parts[i].content)))
-		return ds
+	return _getClient(verify)._WADO(URL, study, series, SOP, frames,
+	                                dataSource, anonymize, mode, token, stream,
+	                                outDir)
+
+
+def retrieveFrames(URL,
+                   study,
+                   series,
+                   SOP,
+                   frames,
+                   raw=False,
+                   cacheDir=None,
+                   dataSource=None,
+                   token=None,
+                   verify=True):
+	"""
+	Retrieve only the requested frames of a (multi-frame) DICOM instance
+		URL is the same as for WADO
+		frames is a frame number, list or range of frame numbers, or string such as '1,3,5-8'
+		Returns the decoded frames stacked as a numpy array, or a list of the raw frame bytes if raw is set
+		Frames are requested in their stored transfer syntax, compressed frames are decoded by pydicom
+		Set cacheDir to cache frames on disk by SOP Instance UID and frame number so they are only retrieved once
+	"""
+	return _getClient(verify)._retrieveFrames(URL, study, series, SOP, frames,
+	                                          raw, cacheDir, dataSource, token)
+
+
+def retrieveBulkdata(URI, token=None, verify=True):
+	"""
+	Retrieve the bytes of a BulkDataURI found in WADO JSON/XML metadata
+	"""
+	return _getClient(verify)._bulkdata(URI, token)
+
+
+def retrieveStudy(URL,
+                  study,
+                  outDir=None,
+                  level='series',
+                  workers=4,
+                  maxRetry=3,
+                  dataSource=None,
+                  anonymize=None,
+                  progress=True,
+                  token=None,
+                  verify=True):
+	"""
+	Retrieve a whole DICOM study in parallel, writing instances to outDir as they arrive
+		URL is the DICOMweb base URL as used by QIDO, instances are retrieved from URL + 'studies/'
+		Uses QIDO to list the series (and instances if level is 'instance') then WADO on a pool of workers
+		Options for level are 'series' and 'instance'
+		Each series or instance is retried up to maxRetry times
+		progress is either a boolean to print progress or a function called with (done, total, item)
+		Creates a temporary directory to save to if not given one
+		Returns a dictionary of the outDir, the saved file paths, and the (series, SOP) items that failed
+	"""
+	return _getClient(verify)._retrieveStudy(URL, URL + 'studies/', study,
+	                                         outDir, level, workers, maxRetry,
+	                                         dataSource, anonymize, progress,
+	                                         token)
 
 
 def exportDS(ds, outDir=None, openDir=True):
@@ -169,168 +2087,1026 @@ def exportDS(ds, outDir=None, openDir=True):
 		Creates and returns a temporary directory to save to if not given one
 		Opens directory folder in file explorer by default
 	"""
-	if outDir == None:
-		from tempfile import mkdtemp
-		outDir = mkdtemp()
-	counter = {}
+	if outDir == None:
+		from tempfile import mkdtemp
+		outDir = mkdtemp()
+	counter = {}
+
+	if type(ds) == pd.dataset.FileDataset:
+		ds = [ds]
+	for dsi in ds:
+		try:
+			modality = dsi.Modality
+		except:
+			modality = 'IMG'
+		if modality not in counter:
+			counter[modality] = 0
+		dsi.save_as(outDir + '\\' + modality + str(counter[modality]) + '.dcm')
+		counter[modality] += 1
+	if openDir:
+		os.startfile(outDir)
+	return outDir
+
+
+def STOW(URL,
+         inDir,
+         study=None,
+         dataSource=None,
+         token=None,
+         verify=True,
+         maxInstances=1024,
+         maxBytes=536870912,
+         workers=4,
+         maxRetry=3,
+         journal=None,
+         resume=False,
+         job=None,
+         compress=None,
+         compressWorkers=4):
+	"""
+	Store DICOM file(s) to server using RESTful API
+		inDir is either a DICOM file, directory of DICOM files, pydicom dataset, or list of pydicom datasets or scanDCM records
+		Works recursively through subdirectories to collect DICOM files if given a directory
+		Instances are split into multipart batches of at most maxInstances instances and maxBytes bytes
+		Batch bodies are streamed from disk and posted concurrently on workers threads
+		Returns a dictionary of the status codes and response content of each request in batch order,
+		the stored SOP Instance UIDs, and the failed (SOP Instance UID or file, reason) pairs
+		journal is a TransferJournal or SQLite file path to record the delivery status of each SOP Instance
+		Set resume with journal to only send instances not already stored by the same job (named by URL unless given job)
+		Set compress to a lossless Transfer Syntax UID, or True to pick JPEG-LS, JPEG 2000, or RLE Lossless by installed codecs,
+		to compress uncompressed instances on compressWorkers threads before sending, instances the server rejects are resent as is in another request
+		Reuses pooled connections between calls, use DICOMwebClient for control over pooling and retries
+	"""
+	return _getClient(verify)._STOW(URL, inDir, study, dataSource, token,
+	                                maxInstances, maxBytes, workers, maxRetry,
+	                                journal, resume, job, compress,
+	                                compressWorkers)
+
+
+class AsyncDICOMwebClient(object):
+	"""
+	asyncio DICOMweb client for QIDO, WADO, and STOW built on a shared aiohttp session
+		URL is the DICOMweb base URL, QIDO queries go to URL and WADO/STOW requests to URL + 'studies/'
+		limit caps the total number of open connections and limitPerHost the open connections to each host
+		Requests are cancelled by cancelling the awaiting task, which releases its connection
+		Must be created within a running event loop, use as an async context manager or await close() when done
+		Requires aiohttp
+	"""
+	def __init__(self,
+	             URL=None,
+	             token=None,
+	             verify=True,
+	             limit=100,
+	             limitPerHost=10):
+		import aiohttp
+
+		self.URL = URL
+		self.token = token
+		if verify == True:
+			verify = cert
+		sslContext = None
+		if verify == False:
+			sslContext = False
+		elif type(verify) == str:
+			import ssl
+
+			# Fail on a missing CA bundle the same way requests does for DICOMwebClient
+			if os.path.isfile(verify):
+				sslContext = ssl.create_default_context(cafile=verify)
+			elif os.path.isdir(verify):
+				sslContext = ssl.create_default_context(capath=verify)
+			else:
+				raise OSError(
+				    'Could not find a suitable TLS CA certificate bundle, invalid path: '
+				    + verify)
+		self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+		    limit=limit, limit_per_host=limitPerHost, ssl=sslContext))
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *args):
+		await self.close()
+
+	async def close(self):
+		"""
+		Close all pooled connections
+		"""
+		await self.session.close()
+
+	def _headers(self, token=None):
+		"""
+		Build request headers with the bearer token, if any
+		"""
+		headers = {}
+		if token == None:
+			token = self.token
+		if token != None:
+			headers['Authorization'] = 'Bearer ' + token
+		return headers
+
+	async def QIDO(self,
+	               study=None,
+	               series=None,
+	               SOP=None,
+	               patientId=None,
+	               dataSource=None,
+	               anonymize=None,
+	               mode=None,
+	               limit=None,
+	               offset=None,
+	               includefield=None,
+	               fuzzy=False,
+	               studyDate=None,
+	               filters=None):
+		"""
+		Query for a DICOM study, series, or instance by it's UIDs
+			See the module level QIDO for options
+		"""
+		return await self._QIDO(self.URL, study, series, SOP, patientId,
+		                        dataSource, anonymize, mode, None, limit,
+		                        offset, includefield, fuzzy, studyDate, filters)
+
+	async def WADO(self,
+	               study,
+	               series=None,
+	               SOP=None,
+	               frames=None,
+	               dataSource=None,
+	               anonymize=None,
+	               mode=None):
+		"""
+		Retrieve a DICOM study, series, or instance XML/JSON metadata or DICOM object binary
+			See the module level WADO for options
+		"""
+		return await self._WADO(self.URL + 'studies/', study, series, SOP,
+		                        frames, dataSource, anonymize, mode)
+
+	async def STOW(self,
+	               inDir,
+	               study=None,
+	               dataSource=None,
+	               maxInstances=1024,
+	               maxBytes=536870912,
+	               workers=4,
+	               maxRetry=3):
+		"""
+		Store DICOM file(s) to server using RESTful API
+			See the module level STOW for options
+		"""
+		return await self._STOW(self.URL + 'studies/', inDir, study,
+		                        dataSource, None, maxInstances, maxBytes,
+		                        workers, maxRetry)
+
+	async def _multipart(self, r):
+		"""
+		Read each part of a multipart response
+		"""
+		import aiohttp
+
+		parts = []
+		reader = aiohttp.MultipartReader.from_response(r)
+		while True:
+			part = await reader.next()
+			if part == None:
+				break
+			parts.append(await part.read(decode=False))
+		return parts
+
+	async def _QIDO(self,
+	                URL,
+	                study=None,
+	                series=None,
+	                SOP=None,
+	                patientId=None,
+	                dataSource=None,
+	                anonymize=None,
+	                mode=None,
+	                token=None,
+	                limit=None,
+	                offset=None,
+	                includefield=None,
+	                fuzzy=False,
+	                studyDate=None,
+	                filters=None):
+		URL = _qidoURL(URL, study, series, SOP, patientId, dataSource,
+		               anonymize, limit, offset, includefield, fuzzy, studyDate,
+		               filters)
+		if URL == None:
+			print('Error: Not enough values to query')
+			return []
+		headers = self._headers(token)
+		mode = str(mode)
+		if mode.lower() == 'xml':
+			headers['Accept'] = 'multipart/related; type=application/dicom+xml'
+			async with self.session.get(URL, headers=headers) as r:
+				if r.status != 200 or DEBUG:
+					print(r.status)
+					if r.status != 200:
+						print(await r.text())
+				if r.status != 200:
+					return []
+				return await self._multipart(r)
+		else:
+			headers['Accept'] = 'application/json'
+			async with self.session.get(URL, headers=headers) as r:
+				if r.status != 200 or DEBUG:
+					print(r.status)
+					print(await r.text())
+				if r.status != 204:
+					return await r.json(content_type=None)
+				else:
+					return []
+
+	async def _WADO(self,
+	                URL,
+	                study,
+	                series=None,
+	                SOP=None,
+	                frames=None,
+	                dataSource=None,
+	                anonymize=None,
+	                mode=None,
+	                token=None):
+		mode = str(mode)
+		URL = _wadoURL(URL, study, series, SOP, frames, dataSource, anonymize,
+		               mode)
+		headers = self._headers(token)
+		if mode.lower() == 'json':
+			headers['Accept'] = 'application/dicom+json'
+			async with self.session.get(URL, headers=headers) as r:
+				if r.status != 200 or DEBUG:
+					print(r.status)
+					print(await r.text())
+				return await r.json(content_type=None)
+		elif mode.lower() == 'xml':
+			headers['Accept'] = 'application/dicom+xml'
+			async with self.session.get(URL, headers=headers) as r:
+				if r.status not in [200, 206] or DEBUG:
+					print(r.status)
+					print(await r.text())
+				return await r.read()
+		else:
+			if frames != None and SOP != None:
+				headers[
+				    'Accept'] = 'multipart/related; type="application/octet-stream"; transfer-syntax=*'
+			else:
+				headers[
+				    'Accept'] = 'multipart/related; type=application/dicom'
+			async with self.session.get(URL, headers=headers) as r:
+				if r.status != 200 or DEBUG:
+					print(r.status)
+					if r.status != 200:
+						print(await r.text())
+				if r.status != 200:
+					return []
+				parts = await self._multipart(r)
+			if frames != None and SOP != None:
+				return parts
+			return [
+			    pd.dcmread(pd.filebase.DicomBytesIO(content))
+			    for content in parts
+			]
+
+	async def _STOW(self,
+	                URL,
+	                inDir,
+	                study=None,
+	                dataSource=None,
+	                token=None,
+	                maxInstances=1024,
+	                maxBytes=536870912,
+	                workers=4,
+	                maxRetry=3):
+		import asyncio
+
+		if study != None:
+			URL += study
+		if dataSource != None:
+			URL += '?datasource=' + dataSource
+		headers = self._headers(token)
+		headers['Accept'] = 'application/dicom+json'
+		loop = asyncio.get_event_loop()
+
+		# Collecting parts reads the filesystem, so keep it off the event loop
+		parts = await loop.run_in_executor(None, _stowParts, inDir)
+		if parts == None:
+			return {}
+		batches = _stowBatches(parts, maxInstances, maxBytes)
+		semaphore = asyncio.Semaphore(workers)
+
+		async def post(i):
+			batch = batches[i]
+			async with semaphore:
+				for j in range(maxRetry):
+					try:
+						body = _MultipartStream(batch)
+						batchHeaders = dict(headers)
+						batchHeaders[
+						    'Content-Type'] = 'multipart/related; type="application/dicom"; boundary=' + body.boundary
+						batchHeaders['Content-Length'] = str(len(body))
+
+						async def chunks():
+							while True:
+								chunk = await loop.run_in_executor(
+								    None, body.read, body.chunkSize)
+								if not chunk:
+									break
+								yield chunk
+
+						async with self.session.post(URL,
+						                             headers=batchHeaders,
+						                             data=chunks()) as r:
+							content = await r.read()
+							print(
+							    str(r.status) + ' (batch ' + str(i + 1) + '/' +
+							    str(len(batches)) + ', ' + str(len(batch)) +
+							    ' instances)')
+							if r.status not in [200, 202] or DEBUG:
+								print(content.decode(errors='ignore'))
+							if r.status < 500 or j == maxRetry - 1:
+								return r.status, content, _stowStatus(
+								    r.status, content, batch)
+					except Exception as e:
+						print('Error: ' + str(e))
+			reason = 'Failed to STOW after ' + str(maxRetry) + ' attempts'
+			return None, b'', ([], [(part[2], reason) for part in batch])
+
+		results = await asyncio.gather(
+		    *[post(i) for i in range(len(batches))])
+		output = {'status': [], 'content': [], 'stored': [], 'failed': []}
+		for status, content, (stored, failed) in results:
+			output['status'].append(status)
+			output['content'].append(content)
+			output['stored'] += stored
+			output['failed'] += failed
+		if len(batches) > 1:
+			print('STOWed ' + str(len(output['stored'])) + ' instances in ' +
+			      str(len(batches)) + ' batches, ' +
+			      str(len(output['failed'])) + ' failed')
+		return output
+
+
+# Shared async clients used by aQIDO, aWADO, and aSTOW, one (client, closer) per event loop and verify setting
+_asyncClients = {}
+
+
+async def _closeOnShutdown(client):
+	"""
+	Async generator parked at its yield which closes client when the event loop finalizes async generators,
+	as asyncio.run does before closing the loop
+	"""
+	try:
+		yield
+	finally:
+		await client.close()
+
+
+def _getAsyncClient(verify=True):
+	"""
+	Get the shared async DICOMweb client for the running event loop and a verify setting
+	"""
+	import asyncio
+
+	loop = asyncio.get_event_loop()
+	for key in list(_asyncClients):
+		if key[0].is_closed():
+			client, _closer = _asyncClients.pop(key)
+			# A loop closed without shutdown_asyncgens leaves its session open, which cannot be closed without the loop
+			if not client.session.closed:
+				print('Warning: Shared async DICOMweb client of a closed event ' +
+				      'loop was not closed, await aClose() before closing it')
+	if (loop, verify) not in _asyncClients:
+		client = AsyncDICOMwebClient(verify=verify)
+		closer = _closeOnShutdown(client)
+		asyncio.ensure_future(closer.__anext__())
+		_asyncClients[(loop, verify)] = (client, closer)
+	return _asyncClients[(loop, verify)][0]
+
+
+async def aQIDO(URL,
+                study=None,
+                series=None,
+                SOP=None,
+                patientId=None,
+                dataSource=None,
+                anonymize=None,
+                mode=None,
+                token=None,
+                verify=True,
+                limit=None,
+                offset=None,
+                includefield=None,
+                fuzzy=False,
+                studyDate=None,
+                filters=None):
+	"""
+	asyncio version of QIDO, returns the same results
+		Calls in the same event loop share one connection pool, see AsyncDICOMwebClient to set connection limits
+	"""
+	return await _getAsyncClient(verify)._QIDO(URL, study, series, SOP,
+	                                           patientId, dataSource,
+	                                           anonymize, mode, token, limit,
+	                                           offset, includefield, fuzzy,
+	                                           studyDate, filters)
+
+
+async def aWADO(URL,
+                study,
+                series=None,
+                SOP=None,
+                frames=None,
+                dataSource=None,
+                anonymize=None,
+                mode=None,
+                token=None,
+                verify=True):
+	"""
+	asyncio version of WADO, returns the same results
+		Calls in the same event loop share one connection pool, see AsyncDICOMwebClient to set connection limits
+	"""
+	return await _getAsyncClient(verify)._WADO(URL, study, series, SOP,
+	                                           frames, dataSource, anonymize,
+	                                           mode, token)
+
+
+async def aSTOW(URL,
+                inDir,
+                study=None,
+                dataSource=None,
+                token=None,
+                verify=True,
+                maxInstances=1024,
+                maxBytes=536870912,
+                workers=4,
+                maxRetry=3):
+	"""
+	asyncio version of STOW, returns the same results
+		Calls in the same event loop share one connection pool, see AsyncDICOMwebClient to set connection limits
+	"""
+	return await _getAsyncClient(verify)._STOW(URL, inDir, study, dataSource,
+	                                           token, maxInstances, maxBytes,
+	                                           workers, maxRetry)
+
+
+async def aClose():
+	"""
+	Close the shared connection pools of aQIDO, aWADO, and aSTOW for the running event loop
+		They are also closed when asyncio.run shuts the loop down
+	"""
+	import asyncio
+
+	loop = asyncio.get_event_loop()
+	for key in list(_asyncClients):
+		if key[0] == loop:
+			client, _closer = _asyncClients.pop(key)
+			await client.close()
+
+
+def _aeTitle(title):
+	"""
+	AE title as bytes for pynetdicom 1.x or str for later versions
+	"""
+	import pynetdicom
+
+	if pynetdicom.__version__.split('.')[0] in ['0', '1']:
+		if type(title) != bytes:
+			title = title.encode()
+	elif type(title) == bytes:
+		title = title.decode()
+	return title
+
+
+class AssociationPool(object):
+	"""
+	Keeps C-STORE associations open per (server, port, called AE title) so repeated C_STORE calls reuse a warm link
+		An open association is reused when it already requested every presentation context needed
+		Otherwise an idle association is renegotiated with its previous contexts plus the new ones
+		Associations left idle for longer than idleTimeout seconds are released
+		callingAE defaults to the COMPUTERNAME environment variable, or the host name
+	"""
+	def __init__(self, idleTimeout=60, callingAE=None):
+		from pynetdicom import AE
+		from socket import gethostname
+
+		if callingAE == None:
+			callingAE = os.getenv('COMPUTERNAME', gethostname()[:16])
+		self.callingAE = callingAE
+		self.idleTimeout = idleTimeout
+		self.ae = AE(ae_title=_aeTitle(callingAE))
+		self.ae.dimse_timeout = None
+		self.ae.acse_timeout = None
+		self.ae.network_timeout = None
+		self.associations = {}
+		self.lock = Lock()
+		self.reaper = None
+		self.stopReaper = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def acquire(self, server, port, ae_title, contexts):
+		"""
+		Get an established association to server supporting the (SOP Class UID, Transfer Syntax UID) pairs in contexts
+			The association is reserved for the caller until it is given back with release or discard
+			Check is_established on the returned association, it is not pooled if it could not be established
+		"""
+		from pynetdicom import build_context
+		from socket import gethostbyname
+		from time import time
+
+		key = (server, port, _aeTitle(ae_title))
+		needed = []
+		for cx in contexts:
+			if cx not in needed:
+				needed.append(cx)
+		with self.lock:
+			entries = self.associations.setdefault(key, [])
+			for entry in entries[:]:
+				if not entry['busy'] and not entry['assoc'].is_established:
+					entries.remove(entry)
+			for entry in entries:
+				if not entry['busy'] and set(needed) <= set(entry['requested']):
+					entry['busy'] = True
+					return entry['assoc']
+			# Renegotiate an idle association which lacks some of the contexts
+			requested = needed
+			renegotiated = None
+			for entry in entries:
+				if not entry['busy']:
+					entries.remove(entry)
+					union = entry['requested'] + [
+					    cx for cx in needed if cx not in entry['requested']
+					]
+					if len(union) <= 128:
+						requested = union
+					renegotiated = entry
+					break
+		# Release outside the lock so other threads are not held up by the round trip
+		if renegotiated != None:
+			try:
+				renegotiated['assoc'].release()
+			except:
+				pass
+		if len(requested) > 128:
+			print('Warning: Only the first 128 of ' + str(len(requested)) +
+			      ' presentation contexts can be requested')
+			requested = requested[:128]
+		assoc = self.ae.associate(
+		    gethostbyname(server),
+		    port,
+		    contexts=[build_context(cx[0], [cx[1]]) for cx in requested],
+		    ae_title=_aeTitle(ae_title),
+		    max_pdu=0)
+		if not assoc.is_established:
+			return assoc
+		with self.lock:
+			self.associations.setdefault(key, []).append({
+			    'assoc': assoc,
+			    'requested': requested,
+			    'busy': True,
+			    'lastUsed': time()
+			})
+			if self.reaper == None and self.idleTimeout != None:
+				from threading import Event, Thread
+				self.stopReaper = Event()
+				self.reaper = Thread(target=self._reap,
+				                     args=(self.stopReaper, ),
+				                     daemon=True)
+				self.reaper.start()
+		return assoc
+
+	def release(self, assoc):
+		"""
+		Give an association back to the pool to be reused
+		"""
+		from time import time
+
+		with self.lock:
+			for entries in self.associations.values():
+				for entry in entries:
+					if entry['assoc'] == assoc:
+						entry['busy'] = False
+						entry['lastUsed'] = time()
+
+	def discard(self, assoc):
+		"""
+		Abort an association which failed and remove it from the pool
+		"""
+		with self.lock:
+			for entries in self.associations.values():
+				for entry in entries[:]:
+					if entry['assoc'] == assoc:
+						entries.remove(entry)
+		try:
+			assoc.abort()
+		except:
+			pass
+
+	def close(self):
+		"""
+		Release every pooled association and stop releasing idle ones
+		"""
+		with self.lock:
+			entries = [
+			    entry for key in self.associations
+			    for entry in self.associations[key]
+			]
+			self.associations = {}
+			if self.reaper != None:
+				self.stopReaper.set()
+				self.reaper = None
+		for entry in entries:
+			try:
+				entry['assoc'].release()
+			except:
+				pass
+
+	def _reap(self, stop):
+		"""
+		Release associations which have been idle for longer than idleTimeout, until stop is set by close
+		"""
+		from time import time
+
+		while not stop.wait(max(min(self.idleTimeout, 5), 0.1)):
+			idle = []
+			with self.lock:
+				for entries in self.associations.values():
+					for entry in entries[:]:
+						if not entry['busy'] and time(
+						) - entry['lastUsed'] > self.idleTimeout:
+							entries.remove(entry)
+							idle.append(entry)
+			for entry in idle:
+				try:
+					entry['assoc'].release()
+				except:
+					pass
+
+
+# Shared association pool used by C_STORE when keepAlive is set
+_associationPool = None
+
+
+def _getAssociationPool():
+	"""
+	Get the shared association pool, releasing its associations at exit
+	"""
+	global _associationPool
+	with _clientsLock:
+		if _associationPool == None:
+			import atexit
+			_associationPool = AssociationPool()
+			atexit.register(_associationPool.close)
+		return _associationPool
+
+
+def _instanceUID(dsn, keyword):
+	"""
+	Get a UID from either a pydicom dataset or a file record
+	"""
+	if type(dsn) == dict:
+		return dsn[keyword]
+	if keyword == 'TransferSyntaxUID':
+		return dsn.file_meta.TransferSyntaxUID
+	return getattr(dsn, keyword)
+
+
+def _instanceData(dsn, decompress=False):
+	"""
+	Get what to pass to send_c_store for a dataset or file record
+		pynetdicom 2+ sends a file path's encoded bytes as is, otherwise the file is read just in time
+		Set decompress to read the full dataset and decompress its pixel data
+	"""
+	import pynetdicom
 
-	if type(ds) == pd.dataset.FileDataset:
-		ds = [ds]
-	for dsi in ds:
-		try:
-			modality = dsi.Modality
-		except:
-			modality = 'IMG'
-		if modality not in counter:
-			counter[modality] = 0
-		dsi.save_as(outDir + '\\' + modality + str(counter[modality]) + '.dcm')
-		counter[modality] += 1
-	if openDir:
-		os.startfile(outDir)
-	return outDir
+	if decompress:
+		if type(dsn) == dict:
+			dsn = pd.dcmread(dsn['path'])
+		if dsn.file_meta.TransferSyntaxUID.is_compressed:
+			from copy import deepcopy
+			dsn = deepcopy(dsn)
+			dsn.decompress()
+		return dsn
+	if type(dsn) != dict:
+		return dsn
+	if pynetdicom.__version__.split('.')[0] in ['0', '1']:
+		return pd.dcmread(dsn['path'])
+	return dsn['path']
 
 
-def STOW(URL, inDir, study=None, dataSource=None, token=None, verify=True):
+def _compressInstance(dsn, syntax):
 	"""
-	Store DICOM file(s) to server using RESTful API
-		inDir is either a DICOM file, directory of DICOM files, pydicom dataset, or list of pydicom datasets
-		Works recursively through subdirectories to collect DICOM files if given a directory
-		NOTE: Limited to 1024 DICOM instances due to a multipart request limitation
+	Read and compress a dataset or file record to syntax for send_c_store, None if it can not be compressed
 	"""
-	if study != None:
-		URL += study
-	if dataSource != None:
-		URL += '?datasource=' + dataSource
-	headers = {}
-	if token != None:
-		headers['Authorization'] = 'Bearer ' + token
-	files = []
-	if type(inDir) == pd.dataset.FileDataset:
-		from tempfile import NamedTemporaryFile
-		dcm = NamedTemporaryFile().name
-		inDir.save_as(dcm)
-		files.append(
-		    ('file', ('file', open(dcm, 'rb').read(), 'application/dicom')))
-		os.remove(dcm)
-	elif type(inDir) == list:
-		from tempfile import NamedTemporaryFile
-		dcm = NamedTemporaryFile().name
-		for ds in inDir:
-			if type(ds) == pd.dataset.FileDataset:
-				ds.save_as(dcm)
-				files.append(
-				    ('file', ('file', open(dcm,
-				                           'rb').read(), 'application/dicom')))
-		os.remove(dcm)
-		if files == []:
-			print('Error: No DICOM files found in inDir')
-			return {}
-	elif os.path.isdir(inDir):
-		for root, _dirs, f in os.walk(inDir):
-			for dcm in f:
-				try:
-					pd.dcmread(root + '\\' + dcm)
-					files.append(
-					    ('file', ('file', open(root + '\\' + dcm, 'rb').read(),
-					              'application/dicom')))
-				except:
-					pass
-		if files == []:
-			print('Error: No DICOM files found in inDir')
-			return {}
-	elif os.path.isfile(inDir):
-		try:
-			pd.dcmread(inDir)
-			files.append(
-			    ('file', ('file', open(inDir,
-			                           'rb').read(), 'application/dicom')))
-		except:
-			print('Error: inDir is not a DICOM file. Skipping file...')
+	if type(dsn) == dict:
+		ds = pd.dcmread(dsn['path'])
 	else:
-		print('Error: inDir is neither a file nor directory')
-		return {}
-	if verify == True:
-		verify = cert
-	r = requests.post(url=URL, files=files, headers=headers, verify=verify)
-	print(r.status_code)
-	if r.status_code not in [200, 202] or DEBUG:
-		print(r.text)
-	return r.content
+		from copy import deepcopy
+		ds = deepcopy(dsn)
+	return _compressDS(ds, syntax)
 
 
-def C_STORE(server, inDir, ae_title=b'DicomServerSCP', port=104):
+def _storeContexts(dsn, fallback=False, compress=None):
 	"""
-	Store DICOM file(s) to server using C-STORE
-		inDir is either a DICOM file, directory of DICOM files, pydicom dataset, or list of pydicom datasets
-		Works recursively through subdirectories to collect DICOM files if given a directory
+	(SOP Class UID, Transfer Syntax UID) presentation contexts to request for a dataset or file record
+		The fallback contexts are the uncompressed little endian transfer syntaxes
+		Uncompressed instances also request the compress transfer syntax first if given
 	"""
-	from pynetdicom import AE, build_context
-	from socket import gethostbyname
+	SOPClass = _instanceUID(dsn, 'SOPClassUID')
+	if fallback:
+		return [(SOPClass, '1.2.840.10008.1.2.1'),
+		        (SOPClass, '1.2.840.10008.1.2')]
+	syntax = _instanceUID(dsn, 'TransferSyntaxUID')
+	if compress != None and not pd.uid.UID(syntax).is_compressed:
+		return [(SOPClass, compress), (SOPClass, syntax)]
+	return [(SOPClass, syntax)]
 
-	if type(ae_title) != bytes:
-		ae_title = ae_title.encode()
-	ae = AE(ae_title=str.encode(os.getenv('COMPUTERNAME')))
 
-	if type(inDir) == list:
-		ds = inDir
-	elif type(inDir) == pd.dataset.FileDataset:
-		ds = [inDir]
-	elif type(inDir) == str:
-		if os.path.isfile(inDir):
-			ds = [pd.dcmread(inDir)]
-		elif os.path.isdir(inDir):
-			ds = []
-			for root, _dirs, files in os.walk(inDir):
-				for f in files:
-					try:
-						ds.append(pd.dcmread(root + '\\' + f))
-					except:
-						pass
+def _contextGroups(ds, fallback=False, compress=None):
+	"""
+	Group datasets or file records by presentation context into lists needing at most 128 contexts each
+	"""
+	contexts = {}
+	for dsn in ds:
+		contexts.setdefault(tuple(_storeContexts(dsn, fallback, compress)),
+		                    []).append(dsn)
+	groups = []
+	group = []
+	n = 0
+	for cx in contexts:
+		if group != [] and n + len(cx) > 128:
+			groups.append(group)
+			group = []
+			n = 0
+		group += contexts[cx]
+		n += len(cx)
+	if group != []:
+		groups.append(group)
+	return groups
 
-	for i in range(len(ds)):
-		try:
-			cx = build_context(ds[i].SOPClassUID,
-			                   [ds[i].file_meta.TransferSyntaxUID])
-			if cx not in ae.requested_contexts:
-				ae.requested_contexts.append(cx)
-		except:
-			pass
 
+def _storeInstances(pool,
+                    server,
+                    port,
+                    ae_title,
+                    ds,
+                    maxRetry=5,
+                    fallback=False,
+                    journal=None,
+                    job=None,
+                    compress=None,
+                    compressor=None,
+                    prefetch=8):
+	"""
+	C-STORE a list of datasets or file records over one association from pool, resuming after failures up to maxRetry times
+		Instances whose presentation context the peer rejected are skipped and returned to be sent another way
+		Set fallback to request uncompressed contexts and decompress each instance before sending
+		Set compress to a Transfer Syntax UID to compress up to prefetch instances ahead on the compressor executor,
+		instances are sent as is if the peer does not accept the compressed context
+		Returns a list of (SOP Instance UID, status) pairs, status is None if the instance was not sent,
+		and the list of rejected instances
+	"""
+	contexts = []
+	for dsn in ds:
+		for cx in _storeContexts(dsn, fallback, compress):
+			if cx not in contexts:
+				contexts.append(cx)
+
+	def compressible(dsn):
+		return (_instanceUID(dsn, 'SOPClassUID'), compress) in accepted and not pd.uid.UID(
+		    _instanceUID(dsn, 'TransferSyntaxUID')).is_compressed
+
+	results = []
+	rejected = []
 	n = 0
-	maxRetry = 5
 	for i in range(maxRetry):
+		assoc = None
 		try:
 			print('Attempting to establish association with ' + server + ':' +
-			      str(port) + ' using Called AE Title ' + ae_title.decode() +
-			      ' and Calling AE Title ' + os.getenv('COMPUTERNAME'))
-			assoc = ae.associate(gethostbyname(server),
-			                     port,
-			                     ae_title=ae_title)
-			assoc.dimse_timeout = None
-			assoc.acse_timeout = None
-			assoc.network_timeout = None
-			assoc.maximum_pdu_size = 0
+			      str(port) + ' using Called AE Title ' +
+			      str(_aeTitle(ae_title)) + ' and Calling AE Title ' +
+			      str(pool.callingAE))
+			assoc = pool.acquire(server, port, ae_title, contexts)
 			if assoc.is_established:
 				print('Association Established')
-				while True:
-					print('Sending SOP Instance ' + ds[n].SOPInstanceUID)
-					assoc.send_c_store(ds[n])
+				accepted = [(cx.abstract_syntax, ts)
+				            for cx in assoc.accepted_contexts
+				            for ts in cx.transfer_syntax]
+				compressing = {}
+				while n < len(ds):
+					SOP = _instanceUID(ds[n], 'SOPInstanceUID')
+					if compressor != None and not fallback:
+						for k in range(n, min(n + prefetch, len(ds))):
+							if k not in compressing and compressible(ds[k]):
+								compressing[k] = compressor.submit(
+								    _compressInstance, ds[k], compress)
+					data = None
+					if n in compressing:
+						data = compressing.pop(n).result()
+					if data == None:
+						if not any([
+						    cx in accepted
+						    for cx in _storeContexts(ds[n], fallback)
+						]):
+							rejected.append(ds[n])
+							n += 1
+							continue
+						data = _instanceData(ds[n], fallback)
+					print('Sending SOP Instance ' + SOP)
+					status = assoc.send_c_store(data)
+					status = getattr(status, 'Status', None)
+					# An empty response means the association was aborted (or
+					# is being aborted after a DIMSE timeout), so leave n on
+					# this instance and resend it over a new association
+					if status == None:
+						raise RuntimeError('Association aborted while sending ' + SOP)
+					results.append((SOP, status))
+					if journal != None:
+						if status == 0 or status in [0xB000, 0xB006, 0xB007]:
+							journal.record(job, SOP, 'stored')
+						else:
+							journal.record(job, SOP, 'failed',
+							               'Status ' + str(status))
 					n += 1
-					if n >= len(ds):
-						break
-				assoc.release()
-				if len(ds) == 1:
+				pool.release(assoc)
+				stored = len([
+				    s for _, s in results
+				    if s == 0 or s in [0xB000, 0xB006, 0xB007]
+				])
+				if stored == 1:
 					print('C-STORED 1 instance')
 				else:
-					print('C-STORED ' + str(len(ds)) + ' instances')
+					print('C-STORED ' + str(stored) + ' instances')
+			elif assoc.rejected_contexts != [] and assoc.accepted_contexts == []:
+				print('Error: Every requested presentation context was rejected')
+				rejected += ds[n:]
+				n = len(ds)
 			else:
 				print('Error: Failed to Establish Association')
 			break
 		except Exception as e:
+			if assoc != None:
+				pool.discard(assoc)
 			if i == maxRetry - 1:
-				print('Error: Failed to C-STORE after five attempts')
+				print('Error: Failed to C-STORE after ' + str(maxRetry) +
+				      ' attempts')
 			else:
 				print('Error: ' + str(e))
+	for dsn in ds[n:]:
+		results.append((_instanceUID(dsn, 'SOPInstanceUID'), None))
+	return results, rejected
+
+
+def C_STORE(server,
+            inDir,
+            ae_title=b'DicomServerSCP',
+            port=104,
+            keepAlive=False,
+            pool=None,
+            associations=1,
+            journal=None,
+            resume=False,
+            job=None,
+            compress=None,
+            compressWorkers=4):
+	"""
+	Store DICOM file(s) to server using C-STORE
+		inDir is either a DICOM file, directory of DICOM files, pydicom dataset, or list of pydicom datasets or scanDCM records
+		Works recursively through subdirectories to collect DICOM files if given a directory
+		Files are scanned header only and read just in time when sent, as is without decoding on pynetdicom 2+
+		Set keepAlive to leave the association open in a shared pool for the next C_STORE call to the same server
+		Or give an AssociationPool as pool to manage the open associations yourself
+		Set associations to split the instances across that many concurrent associations, each on its own thread
+		Instances are grouped by presentation context, using as many associations as needed for more than 128 contexts
+		Instances whose context the peer rejects are retried uncompressed instead of being dropped
+		journal is a TransferJournal or SQLite file path to record the delivery status of each SOP Instance
+		Set resume with journal to only send instances not already stored by the same job (named by destination unless given job)
+		Set compress to a lossless Transfer Syntax UID, or True to pick JPEG-LS, JPEG 2000, or RLE Lossless by installed codecs,
+		to compress uncompressed instances on compressWorkers threads before sending, if the peer accepts that syntax
+		Returns a dictionary of the per instance (SOP Instance UID, status) pairs, the stored SOP Instance UIDs,
+		the failed (SOP Instance UID, status) pairs, and the seconds and instances/sec it took
+	"""
+	from time import time
+	from concurrent.futures import ThreadPoolExecutor
+
+	temporary = False
+	if pool == None:
+		if keepAlive:
+			pool = _getAssociationPool()
+		else:
+			pool = AssociationPool(idleTimeout=None)
+			temporary = True
+
+	if type(inDir) == list:
+		ds = inDir
+	elif type(inDir) == pd.dataset.FileDataset:
+		ds = [inDir]
+	elif type(inDir) == str:
+		# Only the headers are read up front, each file is read again just in time to send it
+		ds = scanDCM(inDir)
+
+	start = time()
+	results = []
+	instances = []
+	for dsn in ds:
+		try:
+			_storeContexts(dsn)
+			instances.append(dsn)
+		except:
+			try:
+				SOP = _instanceUID(dsn, 'SOPInstanceUID')
+			except:
+				SOP = None
+			print('Error: SOP Instance ' + str(SOP) +
+			      ' has no SOP Class or Transfer Syntax UID, skipping instance')
+			results.append((SOP, None))
+
+	journal, closeJournal = _openJournal(journal)
+	if journal != None:
+		if job == None:
+			job = 'C-STORE ' + server + ':' + str(port) + ' ' + (
+			    ae_title.decode() if type(ae_title) == bytes else ae_title)
+		journal.register(job, [(_instanceUID(dsn, 'SOPInstanceUID'),
+		                        dsn['path'] if type(dsn) == dict else None,
+		                        dsn['size'] if type(dsn) == dict else None)
+		                       for dsn in instances])
+		if resume:
+			delivered = journal.delivered(job)
+			print('Resuming ' + job + ', skipping ' + str(
+			    len([
+			        dsn for dsn in instances
+			        if _instanceUID(dsn, 'SOPInstanceUID') in delivered
+			    ])) + ' instances already stored')
+			instances = [
+			    dsn for dsn in instances
+			    if _instanceUID(dsn, 'SOPInstanceUID') not in delivered
+			]
+
+	syntax = _losslessSyntax(compress)
+	compressor = None
+	if syntax != None:
+		compressor = ThreadPoolExecutor(max_workers=compressWorkers)
+
+	def store(groups, fallback=False):
+		# Split each context group into chunks so the work is spread over the associations
+		size = max(-(-sum([len(group) for group in groups]) // associations), 1)
+		chunks = [
+		    group[i:i + size] for group in groups
+		    for i in range(0, len(group), size)
+		]
+		rejected = []
+		with ThreadPoolExecutor(max_workers=associations) as executor:
+			for chunkResults, chunkRejected in executor.map(
+			    lambda chunk: _storeInstances(
+			        pool, server, port, ae_title, chunk, 5, fallback, journal,
+			        job, syntax, compressor, 2 * compressWorkers), chunks):
+				results.extend(chunkResults)
+				rejected += chunkRejected
+		return chunks, rejected
+
+	chunks, rejected = store(_contextGroups(instances, False, syntax))
+	if compressor != None:
+		compressor.shutdown()
+	if rejected != []:
+		print('Retrying ' + str(len(rejected)) +
+		      ' instances with rejected presentation contexts uncompressed')
+		fallbackChunks, rejected = store(_contextGroups(rejected, True), True)
+		chunks += fallbackChunks
+		for dsn in rejected:
+			print('Error: No accepted presentation context for SOP Instance ' +
+			      _instanceUID(dsn, 'SOPInstanceUID'))
+			results.append((_instanceUID(dsn, 'SOPInstanceUID'), None))
+	seconds = time() - start
+
+	output = {'status': results, 'stored': [], 'failed': []}
+	for SOP, status in results:
+		# Warning statuses (0xB000, 0xB006, 0xB007) are still stored
+		if status == 0 or status in [0xB000, 0xB006, 0xB007]:
+			output['stored'].append(SOP)
+		else:
+			output['failed'].append((SOP, status))
+	output['seconds'] = seconds
+	output['instancesPerSecond'] = len(output['stored']) / max(seconds, 1e-6)
+	if len(chunks) > 1:
+		print('C-STORED ' + str(len(output['stored'])) + ' instances over ' +
+		      str(len(chunks)) + ' associations in ' + str(round(seconds, 2)) +
+		      ' seconds (' + str(round(output['instancesPerSecond'], 1)) +
+		      ' instances/sec), ' + str(len(output['failed'])) + ' failed')
+	if journal != None:
+		for SOP, status in results:
+			if status == None and SOP != None:
+				journal.record(job, SOP, 'failed', 'Not sent')
+		output['journal'] = journal.summary(job)
+		_printJournal(job, output['journal'])
+		if closeJournal:
+			journal.close()
+	if temporary:
+		pool.close()
+	return output
 
 
 ###########################################################################################################################
@@ -340,7 +3116,7 @@ def C_STORE(server, inDir, ae_title=b'DicomServerSCP', port=104):
 
 def renameDCM(inDir, patientName=None):
 	"""
-	Change the Patient Name, IDs, and dates of a DICOM file, directory of DICOM files, pydicom dataset, or list of datasets
+	Change the Patient Name, IDs, and dates of a DICOM file, directory of DICOM files, pydicom dataset, or list of datasets or records
 		Returns output as a list
 	"""
 	import random
@@ -348,20 +3124,17 @@ def renameDCM(inDir, patientName=None):
 
 	# Parse input so that it is a list
 	if type(inDir) == list:
-		ds = inDir
+		ds = [
+		    pd.dcmread(dsn['path']) if type(dsn) == dict else dsn
+		    for dsn in inDir
+		]
 	elif type(inDir) == pd.dataset.FileDataset:
 		ds = [inDir]
 	elif type(inDir) == str:
 		if os.path.isfile(inDir):
 			ds = [pd.dcmread(inDir)]
 		elif os.path.isdir(inDir):
-			ds = []
-			for root, _dirs, files in os.walk(inDir):
-				for f in files:
-					try:
-						ds.append(pd.dcmread(root + '\\' + f))
-					except:
-						pass
+			ds = [pd.dcmread(record['path']) for record in scanDCM(inDir)]
 	else:
 		print('Error: inDir is neither a file, directory, list, nor dataset')
 		exit()
@@ -483,13 +3256,12 @@ def resizeDCM(inDir, outDir=None, xScale=0.5, yScale=0.5):
 		if os.path.isfile(inDir):
 			ds = pd.dcmread(inDir)
 		elif os.path.isdir(inDir):
-			ds = []
-			for root, _dirs, files in os.walk(inDir):
-				for f in files:
-					try:
-						ds.append(pd.dcmread(root + '\\' + f))
-					except:
-						pass
+			ds = [pd.dcmread(record['path']) for record in scanDCM(inDir)]
+	elif type(inDir) == list:
+		ds = [
+		    pd.dcmread(dsn['path']) if type(dsn) == dict else dsn
+		    for dsn in inDir
+		]
 	else:
 		ds = inDir
 	if type(ds) == pd.dataset.FileDataset:
@@ -508,146 +3280,793 @@ def resizeDCM(inDir, outDir=None, xScale=0.5, yScale=0.5):
 	return output
 
 
-def loadVolumes(inDir, n1mm3=False, windowMode=None):
+def _slicePixels(dsn):
 	"""
-	Load a DICOM study located in a directory or list as 3D volume(s)
-		Stored as a 3D numpy array
-		Set n1mm3 to normalize 3D numpy array to 1 mm3 voxels
-		Set defaultWindow to use window volume using default window/level values found in DICOM header of first file in folder
-		View these volumes slice by slice using sliceViewer
-		View these volumes in 3D using volViewer (may require additional processing beforehand)
+	Decode the pixel data of a pydicom dataset or DICOM file path
+		Datasets which can not be decoded as they are, e.g. missing file meta, are encoded and read again in memory
+	"""
+	if type(dsn) == str:
+		return pd.dcmread(dsn).pixel_array
+	try:
+		return dsn.pixel_array
+	except:
+		return pd.dcmread(pd.filebase.DicomBytesIO(_encodeDS(dsn))).pixel_array
+
+
+def _decodeSlices(executor, sources, raw, index, processes=False, depth=8):
+	"""
+	Decode datasets or file paths into raw[index[i]] on executor, keeping at most depth slices in flight
+		Threads write each slice straight into raw, slices decoded in processes are written as they come back
+	"""
+	from collections import deque
+
+	def decode(i):
+		raw[index[i]] = _slicePixels(sources[i])
+
+	pending = deque()
+
+	def finish():
+		i, future = pending.popleft()
+		if processes:
+			raw[index[i]] = future.result()
+		else:
+			future.result()
+
+	for i in range(len(sources)):
+		if len(pending) >= depth:
+			finish()
+		if processes:
+			pending.append((i, executor.submit(_slicePixels, sources[i])))
+		else:
+			pending.append((i, executor.submit(decode, i)))
+	while len(pending) > 0:
+		finish()
+
+
+class LazyVolume(object):
+	"""
+	3D volume of a series which only decodes the slices that are accessed
+		Supports NumPy style indexing, shape, dtype, ndim, and len, so it works with sliceViewer and window
+		np.asarray(volume) decodes every slice, the cacheSlices most recently accessed slices are kept decoded
+	"""
+	def __init__(self, sources, index, shape, dtype=np.int16, cacheSlices=64):
+		from collections import OrderedDict
+
+		self.sources = dict(zip(index, sources))
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		self.ndim = len(self.shape)
+		self.cacheSlices = cacheSlices
+		self.cache = OrderedDict()
+		self.lock = Lock()
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __array__(self, dtype=None, copy=None):
+		if dtype == None:
+			return self[:]
+		return self[:].astype(dtype)
+
+	def _slice(self, k):
+		"""
+		Decoded slice k, slices missing from the series are zeros
+		"""
+		with self.lock:
+			if k in self.cache:
+				self.cache.move_to_end(k)
+				return self.cache[k]
+		out = np.zeros(self.shape[1:], dtype=self.dtype)
+		if k in self.sources:
+			out[...] = _slicePixels(self.sources[k])
+		with self.lock:
+			self.cache[k] = out
+			while len(self.cache) > self.cacheSlices:
+				self.cache.popitem(last=False)
+		return out
+
+	def __getitem__(self, key):
+		if type(key) != tuple:
+			key = (key, )
+		if key == () or key[0] is Ellipsis:
+			key = (slice(None), ) + key
+		slices = np.arange(self.shape[0])[key[0]]
+		if slices.ndim == 0:
+			return self._slice(int(slices))[key[1:]]
+		out = np.empty((len(slices), ) + self.shape[1:], dtype=self.dtype)
+		for i in range(len(slices)):
+			out[i] = self._slice(int(slices[i]))
+		return out[(slice(None), ) + key[1:]]
+
+
+class VolumeCache(object):
+	"""
+	On-disk cache of decoded volumes keyed by SeriesInstanceUID and processing options, for iterVolumes and loadVolumes
+		Keeps up to maxBytes of volumes in cacheDir, least recently used are evicted first
+		Entries are invalidated when the series' source files change size or modification time
+		Volumes are stored as .npy files and read back copy-on-write memory mapped without copying,
+		set compress to store zlib compressed chunks of chunk slices instead, which must be decompressed when read
+		hits, misses, invalidations, and evictions are counted, see stats
+	"""
+	def __init__(self,
+	             cacheDir,
+	             maxBytes=10737418240,
+	             compress=False,
+	             chunk=64):
+		from collections import OrderedDict
+
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.compress = compress
+		self.chunk = chunk
+		# Sizes of the cached volume files, least recently used first
+		self.entries = OrderedDict()
+		self.size = 0
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+		self.evictions = 0
+		if not os.path.isdir(cacheDir):
+			os.makedirs(cacheDir)
+		files = []
+		for f in os.scandir(cacheDir):
+			if f.name.endswith('.npy') or f.name.endswith('.npz'):
+				stat = f.stat()
+				files.append((stat.st_mtime, f.name[:-4], stat.st_size))
+		for _mtime, key, size in sorted(files):
+			self.entries[key] = size
+			self.size += size
+
+	def key(self, series, options):
+		"""
+		Cache key from the Series Instance UID and the processing options the volume was made with
+		"""
+		from hashlib import sha256
+
+		return sha256((series + '\n' + repr(options)).encode()).hexdigest()
+
+	def fingerprint(self, records):
+		"""
+		Hash of the (path, size, mtime) of each slice file, or SOP Instance UID of each in memory dataset
+		"""
+		from hashlib import sha256
+
+		items = []
+		for record in records:
+			if type(record['source']) == str:
+				stat = os.stat(record['source'])
+				items.append(record['source'] + '|' + str(stat.st_size) + '|' +
+				             str(stat.st_mtime))
+			else:
+				items.append(str(record['SOPInstanceUID']))
+		return sha256('\n'.join(sorted(items)).encode()).hexdigest()
+
+	def get(self, key, fingerprint):
+		"""
+		Look up a cached (volume, geometry) pair, None if missing or its source files changed
+		"""
+		import json
+
+		# Files are read without the lock, which only guards the LRU list and counters
+		path = os.path.join(self.cacheDir, key)
+		try:
+			with open(path + '.meta', 'r') as f:
+				meta = json.load(f)
+		except:
+			with self.lock:
+				self.misses += 1
+			return None
+		if meta['fingerprint'] != fingerprint:
+			with self.lock:
+				self.invalidations += 1
+				self.misses += 1
+			self._remove(key)
+			return None
+		try:
+			if meta['compress']:
+				with np.load(path + '.npz') as chunks:
+					volume = np.concatenate([
+					    chunks['chunk' + str(i)]
+					    for i in range(meta['chunks'])
+					])
+				os.utime(path + '.npz')
+			else:
+				# Copy-on-write so callers can modify the volume without touching the cache
+				volume = np.load(path + '.npy', mmap_mode='c')
+				os.utime(path + '.npy')
+		except:
+			with self.lock:
+				self.misses += 1
+			self._remove(key)
+			return None
+		with self.lock:
+			self.hits += 1
+			if key in self.entries:
+				self.entries.move_to_end(key)
+		geometry = meta['geometry']
+		if geometry.get('spacing') != None:
+			geometry['spacing'] = tuple(geometry['spacing'])
+		return volume, geometry
+
+	def put(self, key, fingerprint, series, volume, geometry):
+		"""
+		Cache a volume and its geometry
+		"""
+		import json
+		from tempfile import mkstemp
+
+		def write(target, save):
+			# Write to a unique temporary file and rename it into place so that
+			# concurrent writers and readers never see a partial file
+			fd, tmp = mkstemp(dir=self.cacheDir)
+			try:
+				with os.fdopen(fd, 'wb') as f:
+					save(f)
+				os.replace(tmp, target)
+			except:
+				os.remove(tmp)
+				raise
+
+		path = os.path.join(self.cacheDir, key)
+		try:
+			if self.compress:
+				chunks = {}
+				for i in range(0, len(volume), self.chunk):
+					chunks['chunk' + str(i // self.chunk)] = np.asarray(
+					    volume[i:i + self.chunk])
+				write(path + '.npz', lambda f: np.savez_compressed(f, **chunks))
+				size = os.path.getsize(path + '.npz')
+			else:
+				write(path + '.npy', lambda f: np.save(f, np.asarray(volume)))
+				size = os.path.getsize(path + '.npy')
+			meta = {
+			    'series': series,
+			    'fingerprint': fingerprint,
+			    'compress': self.compress,
+			    'chunks': -(-len(volume) // self.chunk),
+			    'geometry': geometry
+			}
+			write(path + '.meta', lambda f: f.write(json.dumps(meta).encode()))
+		except Exception as e:
+			print('Error: Unable to write volume cache ' + str(e))
+			return
+		evicted = []
+		with self.lock:
+			self.size -= self.entries.pop(key, 0)
+			self.entries[key] = size
+			self.size += size
+			# Evict the least recently used volumes once over maxBytes
+			while self.size > self.maxBytes and len(self.entries) > 1:
+				oldest, oldestSize = self.entries.popitem(last=False)
+				evicted.append(oldest)
+				self.size -= oldestSize
+				self.evictions += 1
+		for oldest in evicted:
+			self._remove(oldest, False)
+
+	def clear(self):
+		"""
+		Remove all cached volumes from disk
+		"""
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+		for f in os.scandir(self.cacheDir):
+			if f.name.endswith('.meta'):
+				self._remove(f.name[:-5], False)
+
+	def stats(self):
+		"""
+		Hit/miss counters and current size of the cache
+		"""
+		with self.lock:
+			return {
+			    'hits': self.hits,
+			    'misses': self.misses,
+			    'invalidations': self.invalidations,
+			    'evictions': self.evictions,
+			    'entries': len(self.entries),
+			    'bytes': self.size
+			}
+
+	def _remove(self, key, forget=True):
+		# Called without the lock, forget also drops the entry from the LRU list
+		if forget:
+			with self.lock:
+				self.size -= self.entries.pop(key, 0)
+		path = os.path.join(self.cacheDir, key)
+		for ext in ['.meta', '.npy', '.npz']:
+			try:
+				if os.path.isfile(path + ext):
+					os.remove(path + ext)
+			except OSError:
+				# Still memory mapped by a caller on Windows, it is found again when cacheDir is next opened
+				pass
+
+
+def _seriesRecords(inDir):
+	"""
+	Group a directory, list of datasets, or list of records into {study: {series: [record]}} by header records only
+		Each record's source is its file path or dataset, repeated SOP Instances are dropped
 	"""
-	# TODO: Optimize this whole function with threading and queueing
-	ds = {}
 	if type(inDir) == list:
-		from tempfile import NamedTemporaryFile
-		tmp = NamedTemporaryFile().name
-		for dsn in inDir:
-			if dsn.StudyInstanceUID not in ds:
-				ds[dsn.StudyInstanceUID] = {}
-			if dsn.SeriesInstanceUID not in ds[dsn.StudyInstanceUID]:
-				ds[dsn.StudyInstanceUID][dsn.SeriesInstanceUID] = [dsn]
-			if dsn not in ds[dsn.StudyInstanceUID][dsn.SeriesInstanceUID]:
-				ds[dsn.StudyInstanceUID][dsn.SeriesInstanceUID].append(dsn)
+		items = inDir
 	else:
-		tmp = None
-		for root, _dirs, files in os.walk(inDir):
-			for dcm in files:
-				try:
-					dsn = pd.dcmread(root + '\\' + dcm)
-					if dsn.StudyInstanceUID not in ds:
-						ds[dsn.StudyInstanceUID] = {}
-					if dsn.SeriesInstanceUID not in ds[dsn.StudyInstanceUID]:
-						ds[dsn.StudyInstanceUID][dsn.SeriesInstanceUID] = [dsn]
-					if dsn not in ds[dsn.StudyInstanceUID][
-					    dsn.SeriesInstanceUID]:
-						ds[dsn.StudyInstanceUID][dsn.SeriesInstanceUID].append(
-						    dsn)
-				except:
-					pass
-	volumes = []
-	for study in ds:
-		for series in ds[study]:
+		items = scanDCM(inDir, tags=DCMIndex.tags)
+	keywords = ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID'
+	            ] + DCMIndex.tags
+	groups = {}
+	seen = set()
+	for dsn in items:
+		try:
+			if type(dsn) == dict:
+				record = dsn
+				if 'InstanceNumber' not in record:
+					record = _fileRecord(dsn['path'], dsn['size'],
+					                     DCMIndex.tags)
+				record = dict(record, source=record['path'])
+			else:
+				record = {'source': dsn}
+				for keyword in keywords:
+					record[keyword] = dsn.get(keyword)
+			if record['StudyInstanceUID'] == None or record[
+			    'SeriesInstanceUID'] == None or record['SOPInstanceUID'] in seen:
+				continue
+			seen.add(record['SOPInstanceUID'])
+			groups.setdefault(str(record['StudyInstanceUID']), {}).setdefault(
+			    str(record['SeriesInstanceUID']), []).append(record)
+		except:
+			pass
+	return groups
+
+
+def _sliceIndex(records, first):
+	"""
+	Volume index of each slice record by InstanceNumber, or if any InstanceNumber is missing,
+	by ImagePositionPatient along the slice normal from the first slice's ImageOrientationPatient
+	"""
+	if all([record.get('InstanceNumber') != None for record in records]):
+		return [int(record['InstanceNumber']) - 1 for record in records]
+	if first.get('ImageOrientationPatient') == None:
+		raise ValueError(
+		    'Slices have no InstanceNumber or ImageOrientationPatient to order them by'
+		)
+	orientation = [float(x) for x in first.ImageOrientationPatient]
+	normal = np.cross(orientation[:3], orientation[3:])
+	order = sorted(range(len(records)),
+	               key=lambda i: float(
+	                   np.dot(normal, [
+	                       float(x) for x in records[i]['ImagePositionPatient']
+	                   ])))
+	index = [0] * len(records)
+	for k in range(len(order)):
+		index[order[k]] = k
+	return index
+
+
+def _seriesGeometry(first, records, index):
+	"""
+	Geometry of a series as a dictionary of origin, orientation, and (z, y, x) voxel spacing in mm
+		Slice spacing is the median step between ImagePositionPatient along the slice normal, or SliceThickness
+	"""
+	geometry = {'origin': None, 'orientation': None, 'spacing': None}
+	positions = sorted([(index[i], records[i]['ImagePositionPatient'])
+	                    for i in range(len(records))
+	                    if records[i].get('ImagePositionPatient') != None])
+	if positions != []:
+		geometry['origin'] = [float(x) for x in positions[0][1]]
+	z = None
+	if first.get('ImageOrientationPatient') != None:
+		orientation = [float(x) for x in first.ImageOrientationPatient]
+		geometry['orientation'] = orientation
+		if len(positions) > 1:
+			normal = np.cross(orientation[:3], orientation[3:])
+			distance = np.array([np.dot(normal, p) for _k, p in positions])
+			steps = np.diff(distance) / np.diff([k for k, _p in positions])
+			z = float(np.median(np.abs(steps)))
+	if not z and first.get('SliceThickness') != None:
+		z = float(first.SliceThickness)
+	if first.get('PixelSpacing') != None:
+		geometry['spacing'] = (z, float(first.PixelSpacing[0]),
+		                       float(first.PixelSpacing[1]))
+	return geometry
+
+
+def _loadSeries(study, series, records, n1mm3, windowMode, executor, workers,
+                processes, lazy, memmapDir, cache, order):
+	"""
+	Load one series' records as a (volume, geometry) pair for iterVolumes, None if it can not be volumized
+	"""
+	if cache != None and not lazy:
+		try:
+			key = cache.key(series, (n1mm3, windowMode, order))
+			fingerprint = cache.fingerprint(records)
+			cached = cache.get(key, fingerprint)
+			if cached != None:
+				return cached
+		except Exception as e:
+			print('Error: Unable to read volume cache ' + str(e))
+			cache = None
+	try:
+		# Series attributes come from the first slice's header
+		first = records[0]['source']
+		if type(first) == str:
+			first = pd.dcmread(first, stop_before_pixels=True)
+		index = _sliceIndex(records, first)
+		try:
+			geometry = _seriesGeometry(first, records, index)
+		except:
+			geometry = {'origin': None, 'orientation': None, 'spacing': None}
+		if records[0]['Modality'] == 'SEG':
+			raw = _slicePixels(records[0]['source'])
+		else:
+			shape = [max(index) + 1, first.Rows, first.Columns]
+			sources = [record['source'] for record in records]
+			if lazy:
+				return LazyVolume(sources, index, shape), geometry
+			if memmapDir != None:
+				# exist_ok since iterVolumes may prefetch the next series concurrently
+				os.makedirs(memmapDir, exist_ok=True)
+				path = os.path.join(memmapDir, series + '.npy')
+				raw = np.lib.format.open_memmap(path,
+				                                mode='w+',
+				                                dtype=np.int16,
+				                                shape=tuple(shape))
+			else:
+				raw = np.zeros(shape, dtype=np.int16)
+			if executor == None:
+				for i in range(len(sources)):
+					raw[index[i]] = _slicePixels(sources[i])
+			else:
+				_decodeSlices(executor, sources, raw, index, processes,
+				              2 * workers)
+			if memmapDir != None:
+				raw.flush()
+		if n1mm3:
 			try:
-				if ds[study][series][0].Modality == 'SEG':
-					raw = ds[study][series][0].pixel_array
-				else:
-					if tmp != None:
-						ds[study][series][0].save_as(tmp)
-						ds[study][series][0] = pd.dcmread(tmp)
-					c, r = ds[study][series][0].pixel_array.shape
-					n = 0
-					for dsn in ds[study][series]:
-						if dsn.InstanceNumber > n:
-							n = dsn.InstanceNumber
-					raw = np.zeros([n, c, r], dtype=np.int16)
-					for dsn in ds[study][series]:
-						if tmp != None:
-							dsn.save_as(tmp)
-							dsn = pd.dcmread(tmp)
-						raw[dsn.InstanceNumber - 1, :, :] = dsn.pixel_array
-				if n1mm3:
-					try:
-						from warnings import filterwarnings
-						filterwarnings('ignore', '.*output shape of zoom.*')
-						from scipy.ndimage import zoom
-						yScale, xScale = ds[study][series][0].PixelSpacing
-						zScale = float(ds[study][series][0].SliceThickness)
-						raw = zoom(raw, (zScale, yScale, xScale))
-					except:
-						print('Unable to scale study/series ' +
-						      ds[study][series][0].StudyInstanceUID + '/' +
-						      ds[study][series][0].SeriesInstanceUID)
-				if windowMode != None:
-					if windowMode.lower() == 'default':
-						c = int(ds[study][series][0].WindowCenter)
-						w = int(ds[study][series][0].WindowWidth)
-						raw = window(raw, None, c, w)
-					else:
-						raw = window(raw, windowMode)
-				volumes.append(raw)
+				raw = resample(raw, geometry['spacing'], (1.0, 1.0, 1.0), order,
+				               raw.dtype, workers)
+				geometry['spacing'] = (1.0, 1.0, 1.0)
 			except:
-				print('Unable to volumize study/series ' +
-				      ds[study][series][0].StudyInstanceUID + '/' +
-				      ds[study][series][0].SeriesInstanceUID)
-	if tmp != None:
-		os.remove(tmp)
-	return volumes
+				print('Unable to scale study/series ' + study + '/' + series)
+		if windowMode != None:
+			if windowMode.lower() == 'default':
+				c = int(first.WindowCenter)
+				w = int(first.WindowWidth)
+				raw = window(raw, None, c, w)
+			else:
+				raw = window(raw, windowMode)
+		if cache != None and not lazy:
+			cache.put(key, fingerprint, series, raw, geometry)
+		return raw, geometry
+	except:
+		print('Unable to volumize study/series ' + study + '/' + series)
+		return None
+
+
+def iterVolumes(inDir,
+                n1mm3=False,
+                windowMode=None,
+                workers=4,
+                processes=False,
+                lazy=False,
+                memmapDir=None,
+                prefetch=True,
+                cache=None,
+                order=3):
+	"""
+	Load a DICOM study like loadVolumes, yielding (Study Instance UID, Series Instance UID, volume, geometry) per series
+		geometry is a dictionary of origin, orientation, and (z, y, x) voxel spacing in mm
+		Set prefetch to load the next series in the background while the current one is being used
+		Give a VolumeCache as cache to reuse volumes decoded by earlier calls with the same options
+		See loadVolumes for the other options
+	"""
+	from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+	if lazy and (n1mm3 or windowMode != None):
+		print('Error: n1mm3 and windowMode are not applied to lazy volumes')
+	groups = _seriesRecords(inDir)
+	items = [(study, series) for study in groups for series in groups[study]]
+	executor = None
+	if workers != None and processes:
+		executor = ProcessPoolExecutor(max_workers=workers)
+	elif workers != None:
+		executor = ThreadPoolExecutor(max_workers=workers)
+
+	def load(i):
+		study, series = items[i]
+		return _loadSeries(study, series, groups[study][series], n1mm3,
+		                   windowMode, executor, workers, processes, lazy,
+		                   memmapDir, cache, order)
+
+	loader = None
+	future = None
+	if prefetch:
+		loader = ThreadPoolExecutor(max_workers=1)
+	try:
+		for i in range(len(items)):
+			if loader == None:
+				result = load(i)
+			else:
+				if future == None:
+					future = loader.submit(load, i)
+				result = future.result()
+				future = None
+				if i + 1 < len(items):
+					future = loader.submit(load, i + 1)
+			if result != None:
+				yield items[i][0], items[i][1], result[0], result[1]
+	finally:
+		# Finish any prefetched series before its decoding pool is shut down
+		if loader != None:
+			if future != None:
+				future.cancel()
+			loader.shutdown()
+		if executor != None:
+			executor.shutdown()
+
+
+def loadVolumes(inDir,
+                n1mm3=False,
+                windowMode=None,
+                workers=4,
+                processes=False,
+                lazy=False,
+                memmapDir=None,
+                cache=None,
+                order=3):
+	"""
+	Load a DICOM study located in a directory, list of datasets, or list of scanDCM/DCMIndex records as 3D volume(s)
+		Stored as a 3D numpy array
+		Set n1mm3 to normalize 3D numpy array to 1 mm3 voxels, resampled with spline interpolation of order (0, 1, or 3)
+		using the slice spacing from ImagePositionPatient, see resample
+		Set defaultWindow to use window volume using default window/level values found in DICOM header of first file in folder
+		View these volumes slice by slice using sliceViewer
+		View these volumes in 3D using volViewer (may require additional processing beforehand)
+		Slices are decoded on workers threads straight into each volume, or on processes if set,
+		which is faster for codecs that do not release the GIL, set workers to None to decode on the calling thread
+		Files are grouped into series by their headers and read one series at a time
+		Set lazy to return LazyVolume objects which only decode the slices that are accessed, without n1mm3 or windowMode
+		Or set memmapDir to decode each series into a memory mapped SeriesInstanceUID.npy file in that directory
+		Give a VolumeCache as cache to reuse volumes decoded by earlier calls with the same options
+		Use iterVolumes to get one series at a time along with its UIDs and geometry
+	"""
+	return [
+	    volume for _study, _series, volume, _geometry in iterVolumes(
+	        inDir, n1mm3, windowMode, workers, processes, lazy, memmapDir,
+	        False, cache, order)
+	]
+
+
+def _mirrorIndex(i, n):
+	"""
+	Reflect indices into [0, n - 1] like scipy.ndimage's mirror mode
+	"""
+	if n == 1:
+		return np.zeros_like(i)
+	period = 2 * (n - 1)
+	i = np.abs(i) % period
+	return np.where(i >= n, period - i, i)
+
+
+def _resampleAxis(a, out, axis, scale, order):
+	"""
+	Resample a along one axis into out, sampling a at index * scale with spline interpolation of order 0, 1, or 3
+	"""
+	from scipy.ndimage import spline_filter1d
 
+	n = a.shape[axis]
+	x = np.arange(out.shape[axis]) * scale
+	shape = [1] * a.ndim
+	shape[axis] = -1
+	if order == 0:
+		index = np.minimum(np.floor(x + 0.5).astype(np.intp), n - 1)
+		np.take(a, index, axis=axis, out=out)
+		return
+	i = np.minimum(np.floor(x).astype(np.intp), n - 1)
+	t = (x - i).astype(np.float32).reshape(shape)
+	if order == 1:
+		out[...] = np.take(a, i, axis=axis) * (1 - t)
+		out += np.take(a, np.minimum(i + 1, n - 1), axis=axis) * t
+		return
+	# Cubic B-spline of the prefiltered coefficients, 4 taps along the axis
+	c = spline_filter1d(a, 3, axis=axis, output=np.float32, mode='mirror')
+	weights = [(1 - t)**3 / 6, (3 * t**3 - 6 * t**2 + 4) / 6,
+	           (-3 * t**3 + 3 * t**2 + 3 * t + 1) / 6, t**3 / 6]
+	out[...] = 0
+	for k in range(4):
+		out += np.take(c, _mirrorIndex(i + k - 1, n), axis=axis) * weights[k]
 
-def window(img, mode=None, c=None, w=None):
+
+def resample(volume,
+             spacing,
+             newSpacing=(1.0, 1.0, 1.0),
+             order=1,
+             dtype=np.float32,
+             workers=4,
+             chunk=32):
+	"""
+	Resample a 3D volume from its (z, y, x) voxel spacing in mm to newSpacing, e.g. isotropic 1 mm3 voxels
+		Use the spacing from iterVolumes' geometry, which comes from ImagePositionPatient rather than SliceThickness
+		Voxel centers keep their positions, so the first voxel stays at the origin and the output spacing is exact
+		order is the spline interpolation order, 0 nearest, 1 linear, or 3 cubic
+		dtype is the output type, e.g. np.float32 or np.int16, integer types are rounded and clipped
+		Each axis is resampled in a separate pass, in chunks of chunk slices on workers threads
+	"""
+	from concurrent.futures import ThreadPoolExecutor
+
+	if order not in [0, 1, 3]:
+		print('Error: order must be 0, 1, or 3')
+		return volume
+	scale = [float(new) / float(old) for old, new in zip(spacing, newSpacing)]
+	shape = [
+	    int(np.floor((n - 1) / s + 1e-6)) + 1
+	    for n, s in zip(volume.shape, scale)
+	]
+	executor = None
+	if workers != None:
+		executor = ThreadPoolExecutor(max_workers=workers)
+	try:
+		a = np.asarray(volume)
+		if order != 0:
+			a = a.astype(np.float32, copy=False)
+		# Shrinking axes first leaves less work for the later passes
+		for axis in sorted(range(3), key=lambda k: shape[k] / a.shape[k]):
+			outShape = list(a.shape)
+			outShape[axis] = shape[axis]
+			out = np.empty(outShape, dtype=a.dtype)
+			# Split each pass across the slowest axis it does not resample
+			split = 0 if axis != 0 else 1
+			blocks = []
+			for k in range(0, a.shape[split], chunk):
+				index = [slice(None)] * 3
+				index[split] = slice(k, k + chunk)
+				blocks.append(tuple(index))
+
+			def work(index):
+				_resampleAxis(a[index], out[index], axis, scale[axis], order)
+
+			if executor == None:
+				for index in blocks:
+					work(index)
+			else:
+				list(executor.map(work, blocks))
+			a = out
+	finally:
+		if executor != None:
+			executor.shutdown()
+	if np.issubdtype(np.dtype(dtype), np.integer):
+		if not np.issubdtype(a.dtype, np.integer):
+			np.rint(a, out=a)
+			info = np.iinfo(dtype)
+			np.clip(a, info.min, info.max, out=a)
+	return a.astype(dtype, copy=False)
+
+
+# Built in window modes as (center, window)
+_windowPresets = {
+    'bone': (400, 2000),
+    'abdomen': (55, 426),
+    'lung': (-585, 1800),
+    'head': (50, 150)
+}
+_windowLUTs = {}
+_windowLUTsLock = Lock()
+
+
+def _windowInto(img, out, c, scale, offset, mn, mx):
+	"""
+	Window img into out as clip((img - c) * scale + offset, mn, mx), rounding for integer out
+	"""
+	tmp = np.subtract(img, c, dtype=np.float64)
+	np.multiply(tmp, scale, out=tmp)
+	np.add(tmp, offset, out=tmp)
+	np.clip(tmp, mn, mx, out=tmp)
+	if np.issubdtype(out.dtype, np.integer):
+		np.rint(tmp, out=tmp)
+	out[...] = tmp
+
+
+def _windowLUT(c, w, mn, mx, inType, outType):
+	"""
+	Cached lookup table of a window over every value of an 8 or 16 bit integer type, indexed by its unsigned bit pattern
+	"""
+	key = (c, w, mn, mx, inType, outType)
+	with _windowLUTsLock:
+		if key in _windowLUTs:
+			return _windowLUTs[key]
+	unsigned = np.dtype('u' + str(inType.itemsize))
+	values = np.arange(np.iinfo(unsigned).max + 1,
+	                   dtype=unsigned).view(inType)
+	lut = np.empty(values.shape, dtype=outType)
+	_windowInto(values, lut, c, (mx - mn) / w, (mx + mn) / 2, mn, mx)
+	lut.setflags(write=False)
+	with _windowLUTsLock:
+		if len(_windowLUTs) >= 64:
+			del _windowLUTs[next(iter(_windowLUTs))]
+		_windowLUTs[key] = lut
+	return lut
+
+
+def window(img, mode=None, c=None, w=None, out=None, dtype=None, chunk=None):
 	"""
 	Window/level a 3D volume using center and window
 		Recommended center and window are often included in the original DICOM file
 		Built in modes are bone, abdomen, lung, and head
+		Give a list of modes and/or (center, window) pairs, or lists of c and w, to get every window from one pass,
+		stacked as channels on a new last axis
+		Output is float64 between the volume's min and max by default
+		Set dtype (e.g. np.uint8, np.uint16, np.float32) for the output type, integer types use their full range
+		Give an out array to window into instead of allocating a new one, its dtype is used
+		Set chunk to window that many slices at a time, bounding the temporary memory used
+		8 and 16 bit integer volumes are windowed with cached lookup tables
 	"""
-	from copy import deepcopy
-
-	if mode != None:
-		if mode.lower() == 'bone':
-			c = 400
-			w = 2000
-		elif mode.lower() == 'abdomen':
-			c = 55
-			w = 426
-		elif mode.lower() == 'lung':
-			c = -585
-			w = 1800
-		elif mode.lower() == 'head':
-			c = 50
-			w = 150
-	mx = np.max(img)
-	mn = np.min(img)
-	img2 = deepcopy(img)
-	img2 = img2 - c
-	constant1 = (mx - mn) / w
-	constant2 = (mx + mn) / 2
-	if img2.ndim == 3:
-		z, y, x = img2.shape
-		out = np.zeros([z, y, x])
-		for k in range(0, z):
-			for j in range(0, y):
-				for i in range(0, x):
-					out[k, j, i] = constant1 * img2[k, j, i] + constant2
-					if out[k, j, i] <= mn:
-						out[k, j, i] = mn
-					elif out[k, j, i] >= mx:
-						out[k, j, i] = mx
-		return out
-	elif img2.ndim == 2:
-		y, x = img2.shape
-		out = np.zeros([y, x])
-		for j in range(0, y):
-			for i in range(0, x):
-				out[j, i] = constant1 * img2[j, i] + constant2
-				if out[j, i] <= mn:
-					out[j, i] = mn
-				elif out[j, i] >= mx:
-					out[j, i] = mx
-		return out
+	stack = type(mode) in [list, tuple] or type(c) in [list, tuple]
+	if type(mode) in [list, tuple]:
+		modes = list(mode)
+	else:
+		modes = [mode]
+	if type(c) in [list, tuple]:
+		custom = list(zip(c, w))
 	else:
+		custom = [(c, w)]
+	windows = []
+	for m in modes:
+		if type(m) == str and m.lower() in _windowPresets:
+			windows.append(_windowPresets[m.lower()])
+		elif type(m) in [list, tuple]:
+			windows.append(tuple(m))
+		elif stack and m != None:
+			print('Error: Unknown window mode ' + str(m) + ', skipping mode')
+	if not stack and windows == []:
+		windows = custom
+	elif stack:
+		windows += [cw for cw in custom if cw[0] != None]
+
+	if img.ndim not in [2, 3]:
 		print('Error: img not a 2D or 3D numpy array image')
 		return img
+	if out is None:
+		if dtype == None:
+			dtype = np.float64
+		if stack:
+			out = np.empty(img.shape + (len(windows), ), dtype=dtype)
+		else:
+			out = np.empty(img.shape, dtype=dtype)
+	if np.issubdtype(out.dtype, np.integer):
+		mx = np.iinfo(out.dtype).max
+		mn = np.iinfo(out.dtype).min
+	else:
+		mx = float(np.max(img))
+		mn = float(np.min(img))
+
+	if chunk == None:
+		chunk = img.shape[0]
+	if img.dtype.kind in 'iu' and img.dtype.itemsize <= 2:
+		unsigned = np.dtype('u' + str(img.dtype.itemsize))
+		luts = [
+		    _windowLUT(cw[0], cw[1], mn, mx, img.dtype, out.dtype)
+		    for cw in windows
+		]
+		for k in range(0, img.shape[0], chunk):
+			index = np.asarray(img[k:k + chunk]).view(unsigned)
+			for i in range(len(luts)):
+				if stack:
+					out[k:k + chunk, ..., i] = luts[i][index]
+				else:
+					np.take(luts[i], index, out=out[k:k + chunk])
+	else:
+		for k in range(0, img.shape[0], chunk):
+			for i in range(len(windows)):
+				cw, ww = windows[i]
+				if stack:
+					sub = out[k:k + chunk, ..., i]
+				else:
+					sub = out[k:k + chunk]
+				_windowInto(img[k:k + chunk], sub, cw, (mx - mn) / ww,
+				            (mx + mn) / 2, mn, mx)
+	return out
 
 
 def sliceViewer(X):